@@ -0,0 +1,288 @@
+import asyncio
+import os
+import struct
+import threading
+import logging
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import protocol
+import events
+import dedup
+
+SERVER_PORT = 5000
+BUFFER_SIZE = 1024 * 1024
+SERVER_FOLDER = "server"
+IO_WORKERS = 8  # Threads available for file I/O and checksums
+BACKLOG = 1024
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class AsyncServer:
+    """Event-loop engine speaking the same protocol as server.Server for u/d/r/x/e.
+
+    Every connection is a coroutine on one loop instead of an OS thread, and
+    file I/O and checksums run on a bounded thread pool. The ui argument is
+    any event sink (see events.py); without one messages go to the logging
+    module, so the Tk ServerUI is just one possible front-end.
+    """
+
+    def __init__(self, server_ip, server_port, server_folder, ui=None, workers=IO_WORKERS, window_size=protocol.WINDOW_SIZE):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.server_folder = server_folder
+        self.ui = ui or events.LoggingSink()
+        self.workers = workers or IO_WORKERS
+        self.window_size = window_size
+        self.store = dedup.ChunkStore(server_folder)
+        self.server = None
+        self.loop = None
+        self.executor = None
+        self.client_count = 0
+        self.running = False
+
+    def log_message(self, message):
+        self.ui.log_message(message)
+
+    def update_client_count(self):
+        self.ui.update_client_count(self.client_count)
+
+    def start(self):
+        """Run the event loop on a background thread and return once it is listening."""
+        if self.running:
+            self.log_message("Server is already running.")
+            return
+
+        listening = threading.Event()
+        threading.Thread(target=lambda: asyncio.run(self.serve(listening)), daemon=True).start()
+        listening.wait()
+
+    def serve_forever(self):
+        """Run the server on the calling thread until it is stopped."""
+        asyncio.run(self.serve())
+
+    async def serve(self, listening=None):
+        if not os.path.exists(self.server_folder):
+            os.makedirs(self.server_folder)
+            self.log_message(f"\"{self.server_folder}\" Created")
+        else:
+            self.log_message(f"\"{self.server_folder}\" Found")
+
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.server = await asyncio.start_server(self.handle_client, self.server_ip, self.server_port, backlog=BACKLOG)
+        self.server_port = self.server.sockets[0].getsockname()[1]
+        self.running = True
+        self.log_message(f"Server listening on {self.server_ip}:{self.server_port}")
+        if listening:
+            listening.set()
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.running = False
+            self.executor.shutdown(wait=False)
+            self.log_message("Server stopped.")
+
+    def stop(self):
+        if not self.running:
+            self.log_message("Server is not running.")
+            return
+
+        if self.client_count > 0:
+            self.log_message("Cannot stop the server: There are still clients connected.")
+            logging.warning("Attempted to stop the server while clients are still connected.")
+            return
+
+        self.loop.call_soon_threadsafe(self.server.close)
+
+    def run_io(self, func, *args):
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    async def send_data(self, writer, data):
+        writer.write(struct.pack('!I', len(data)))
+        writer.write(data)
+        await writer.drain()
+
+    async def receive_data(self, reader):
+        try:
+            data_len_bytes = await reader.readexactly(4)
+            return await reader.readexactly(struct.unpack('!I', data_len_bytes)[0])
+        except asyncio.IncompleteReadError:
+            return None
+
+    async def receive_chunk(self, reader, writer):
+        retries = 3  # Maximum retry attempts
+        while retries > 0:
+            frame = await self.receive_data(reader)
+            if frame is None:
+                break
+            try:
+                chunk = await self.run_io(protocol.decode_chunk, memoryview(frame))
+                if chunk.valid:
+                    await self.send_data(writer, b"ACK")
+                    return chunk
+                self.log_message(f"Checksum mismatch on chunk {chunk.chunk_num}, requesting retransmission.")
+            except ValueError as e:
+                self.log_message(f"Malformed chunk: {e}")
+            await self.send_data(writer, b"NAK")
+            retries -= 1
+        # Frames still in flight must not be read as requests, so the connection goes.
+        writer.close()
+        return None
+
+    async def send_chunk(self, writer, chunk_num, chunk_data):
+        # This engine only speaks version 1 frames, see the 'v' action.
+        digest = await self.run_io(protocol.chunk_digest, chunk_data)
+        writer.write(protocol.encode_chunk_header(1, protocol.MSG_DATA, 0, chunk_num, len(chunk_data), digest))
+        writer.write(chunk_data)
+        await writer.drain()
+
+    async def send_chunks(self, reader, writer, f):
+        """Async counterpart of protocol.send_chunks reading chunks from f."""
+        in_flight = deque()
+        retransmit = deque()
+        failures = {}
+        chunk_count = 0
+        exhausted = False
+
+        while True:
+            while len(in_flight) < self.window_size:
+                if retransmit:
+                    chunk = retransmit.popleft()
+                elif not exhausted:
+                    chunk_data = await self.run_io(f.read, BUFFER_SIZE)
+                    if not chunk_data:
+                        exhausted = True
+                        break
+                    chunk = (chunk_count, chunk_data)
+                    chunk_count += 1
+                else:
+                    break
+                await self.send_chunk(writer, *chunk)
+                in_flight.append(chunk)
+
+            if not in_flight:
+                break
+
+            ack = await self.receive_data(reader)
+            if ack is None:
+                raise ConnectionError("Connection closed while waiting for ACK")
+            chunk_num, chunk_data = in_flight.popleft()
+            if ack == b"ACK":
+                continue
+            failures[chunk_num] = failures.get(chunk_num, 0) + 1
+            if failures[chunk_num] >= protocol.MAX_RETRIES:
+                raise ConnectionError(f"Chunk {chunk_num} rejected {protocol.MAX_RETRIES} times")
+            retransmit.append((chunk_num, chunk_data))
+
+        await self.send_chunk(writer, chunk_count, b'')
+        if await self.receive_data(reader) != b"ACK":
+            raise ConnectionError("Terminator chunk was not acknowledged")
+
+    def write_at(self, f, offset, data):
+        f.seek(offset)
+        f.write(data)
+
+    async def receive_file(self, reader, writer, filename, address):
+        filepath = os.path.join(self.server_folder, filename)
+        temp_path = os.path.join(self.server_folder, f".{filename}.{uuid.uuid4().hex}.part")
+        f = await self.run_io(open, temp_path, 'wb')
+        chunk_count = 0
+        try:
+            while True:
+                chunk = await self.receive_chunk(reader, writer)
+                if chunk is None or chunk.msg_type == protocol.MSG_END:
+                    break
+                await self.run_io(self.write_at, f, chunk.chunk_num * BUFFER_SIZE, chunk.payload)
+                chunk_count += 1
+        finally:
+            await self.run_io(f.close)
+
+        if chunk is not None and chunk.chunk_num != chunk_count:
+            self.log_message(f"Sender reports {chunk.chunk_num} chunks, {chunk_count} arrived.")
+            chunk = None
+        if chunk is None:
+            await self.run_io(os.remove, temp_path)
+            self.log_message(f"File {filename} upload from {address[0]}:{address[1]} aborted at {datetime.now()}.")
+            return
+
+        await self.run_io(os.replace, temp_path, filepath)
+        await self.run_io(dedup.discard_recipe, filepath, self.store)
+        self.log_message(f"File {filename} received successfully from {address[0]}:{address[1]} at {datetime.now()}.")
+
+    async def send_file(self, reader, writer, filename, address):
+        filepath = os.path.join(self.server_folder, filename)
+        try:
+            f = await self.run_io(dedup.open_stored, filepath, self.store)
+        except FileNotFoundError:
+            self.log_message(f"File {filename} not found at {datetime.now()}.")
+            await self.send_data(writer, b'File not found.')
+            return
+
+        try:
+            filesize = await self.run_io(dedup.stored_size, filepath)
+            await self.send_data(writer, str(filesize).encode())
+            await self.send_chunks(reader, writer, f)
+        finally:
+            await self.run_io(f.close)
+        self.log_message(f"File {filename} sent successfully to {address[0]}:{address[1]} at {datetime.now()}.")
+
+    async def list(self, writer):
+        files = await self.run_io(dedup.stored_files, self.server_folder)
+        await self.send_data(writer, str(len(files)).encode())
+        for filename, file_size in files:
+            await self.send_data(writer, filename.encode() + b'::' + str(file_size).encode())
+
+    def remove_stored(self, filepath):
+        if not dedup.discard_recipe(filepath, self.store):
+            os.remove(filepath)
+
+    async def delete_file(self, writer, filename):
+        try:
+            await self.run_io(self.remove_stored, os.path.join(self.server_folder, filename))
+            self.log_message(f"Deleted file {filename} successfully at {datetime.now()}.")
+            await self.send_data(writer, b"success")
+        except Exception as e:
+            self.log_message(f"Failed to delete file {filename}: {e} at {datetime.now()}.")
+            await self.send_data(writer, b"failure")
+
+    async def handle_client(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        self.client_count += 1
+        self.update_client_count()
+        self.log_message(f"Accepted connection from {address[0]}:{address[1]}")
+        try:
+            while True:
+                action = await self.receive_data(reader)
+                if action is None:
+                    break
+
+                if action == b'v':
+                    await self.receive_data(reader)
+                    await self.send_data(writer, b'1')
+                elif action == b'u':
+                    filename = (await self.receive_data(reader)).decode()
+                    await self.receive_file(reader, writer, filename, address)
+                elif action == b'd':
+                    filename = (await self.receive_data(reader)).decode()
+                    await self.send_file(reader, writer, filename, address)
+                elif action == b'r':
+                    await self.list(writer)
+                elif action == b'x':
+                    filename = (await self.receive_data(reader)).decode()
+                    await self.delete_file(writer, filename)
+                elif action == b'e':
+                    self.log_message(f"Client {address[0]}:{address[1]} connection closed at {datetime.now()}.")
+        except Exception as e:
+            self.log_message(f"Error handling client {address[0]}:{address[1]}: {e} at {datetime.now()}.")
+        finally:
+            writer.close()
+            self.client_count -= 1
+            self.update_client_count()
+            self.log_message(f"Client {address[0]}:{address[1]} connection closed at {datetime.now()}.")
@@ -0,0 +1,170 @@
+import os
+import bisect
+import uuid
+import protocol
+
+# A batch moves many files as one chunk stream: the files are concatenated
+# in manifest order and cut into chunks, so small files share chunks and
+# the whole batch runs in one ACK window. The manifest, a list of
+# [relative path, size] sent ahead, tells the receiver where every byte goes.
+
+
+def safe_path(root, relpath):
+    """Return root/relpath, refusing paths that are absolute, climb out of root or name dot-files."""
+    parts = relpath.replace('\\', '/').split('/')
+    if not relpath or relpath.startswith('/') or any(part in ('', '.', '..') or part.startswith('.') for part in parts):
+        raise ValueError(f"unsafe path {relpath!r}")
+    return os.path.join(root, *parts)
+
+
+def walk_files(directory):
+    """Return the [relative path, size] manifest of the files under directory, dot-files left out."""
+    manifest = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        for name in sorted(filenames):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(dirpath, name)
+            manifest.append([os.path.relpath(path, directory).replace(os.sep, '/'), os.path.getsize(path)])
+    return manifest
+
+
+def compressible_chunks(manifest, chunk_size):
+    """Return, for every chunk of the batch stream, whether most of its bytes come from files worth compressing."""
+    total = sum(size for _, size in manifest)
+    worth = [0] * ((total + chunk_size - 1) // chunk_size)
+    offset = 0
+    for relpath, size in manifest:
+        if protocol.should_compress(relpath):
+            end = offset + size
+            while offset < end:
+                stop = min(end, (offset // chunk_size + 1) * chunk_size)
+                worth[offset // chunk_size] += stop - offset
+                offset = stop
+        else:
+            offset += size
+    return [2 * count >= min(chunk_size, total - chunk_num * chunk_size) for chunk_num, count in enumerate(worth)]
+
+
+class ConcatReader:
+    """Read-only file object over several files one after the other.
+
+    Each file contributes exactly the size given for it, so the stream
+    always matches the manifest the receiver was sent.
+    """
+
+    def __init__(self, files, opener=lambda path: open(path, 'rb')):
+        self.files = files  # [(path, size)]
+        self.opener = opener
+        self.index = 0
+        self.current = None
+        self.remaining = 0
+
+    def seek(self, offset):
+        if offset != 0:
+            raise ValueError("ConcatReader can only seek to the start")
+        self.close()
+        self.index = 0
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            if self.current is None:
+                if self.index >= len(self.files):
+                    break
+                path, self.remaining = self.files[self.index]
+                self.current = self.opener(path)
+                self.index += 1
+            data = self.current.read(min(size, self.remaining))
+            if len(data) < min(size, self.remaining):
+                raise ValueError(f"{self.files[self.index - 1][0]} is shorter than its manifest entry")
+            parts.append(data)
+            size -= len(data)
+            self.remaining -= len(data)
+            if self.remaining == 0:
+                self.current.close()
+                self.current = None
+        return b''.join(parts)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BatchWriter:
+    """Receiving side of a batch: places chunk payloads into dot-prefixed temp files.
+
+    commit() moves every file into place once all chunks arrived, abort()
+    removes the temp files.
+    """
+
+    def __init__(self, root, manifest, chunk_size):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.paths = [safe_path(root, relpath) for relpath, _ in manifest]
+        self.sizes = [size for _, size in manifest]
+        self.starts = []
+        offset = 0
+        for size in self.sizes:
+            self.starts.append(offset)
+            offset += size
+        self.total = offset
+        self.open_index = None
+        self.open_file = None
+        self.token = uuid.uuid4().hex  # Keeps the temp files of concurrent batches apart
+
+    def temp_path(self, path):
+        return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{self.token}.batch.part")
+
+    def prepare(self):
+        for path, size in zip(self.paths, self.sizes):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(self.temp_path(path), 'wb') as f:
+                f.truncate(size)
+
+    def _file(self, index):
+        if self.open_index != index:
+            self.close()
+            self.open_file = open(self.temp_path(self.paths[index]), 'r+b')
+            self.open_index = index
+        return self.open_file
+
+    def write(self, chunk_num, payload):
+        offset = chunk_num * self.chunk_size
+        end = offset + len(payload)
+        index = bisect.bisect_right(self.starts, offset) - 1
+        while offset < end:
+            # Skip the empty files that share this start offset.
+            while self.sizes[index] == 0 or offset >= self.starts[index] + self.sizes[index]:
+                index += 1
+            f = self._file(index)
+            f.seek(offset - self.starts[index])
+            length = min(end, self.starts[index] + self.sizes[index]) - offset
+            start = offset - chunk_num * self.chunk_size
+            f.write(payload[start:start + length])
+            offset += length
+
+    def close(self):
+        if self.open_file is not None:
+            self.open_file.close()
+            self.open_file = None
+            self.open_index = None
+
+    def commit(self):
+        self.close()
+        for path in self.paths:
+            os.replace(self.temp_path(path), path)
+
+    def abort(self):
+        self.close()
+        for path in self.paths:
+            if os.path.exists(self.temp_path(path)):
+                os.remove(self.temp_path(path))
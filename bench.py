@@ -0,0 +1,375 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import shutil
+import multiprocessing
+import events
+import client
+import server
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Loopback benchmark of the transfer path: a headless Server on 127.0.0.1,
+# optionally behind a proxy that adds latency and loss, and 1..N Client
+# threads uploading, listing, downloading and deleting synthetic files.
+# Server and clients share a process, so CPU time covers both ends; each
+# scenario gets a fresh process of its own, so its peak RSS is its own.
+DEFAULT_SIZES = "64K,1M,16M"
+DEFAULT_COUNT = 8
+DEFAULT_CLIENTS = "1"
+LIST_REPEAT = 20  # List requests per client in the list phase
+LOSS_PENALTY = 0.2  # Seconds a "lost" segment is held back, TCP's minimum retransmission timeout
+PROXY_READ = 256 * 1024
+UNITS = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class DelayProxy:
+    """TCP proxy that delays each direction by half the RTT and holds back a fraction of reads.
+
+    Loopback TCP never loses segments, so loss is modelled the way the
+    application sees it: a read is delayed by LOSS_PENALTY, and everything
+    behind it in the stream waits too. Order is always kept.
+    """
+
+    def __init__(self, target_port, rtt=0.0, loss=0.0, seed=0):
+        self.target_port = target_port
+        self.delay = rtt / 2
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                downstream, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+            for sock in (downstream, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.pipe(downstream, upstream)
+            self.pipe(upstream, downstream)
+
+    def pipe(self, source, sink):
+        pending = queue.Queue()
+
+        def read():
+            due = 0.0
+            while True:
+                try:
+                    data = source.recv(PROXY_READ)
+                except OSError:
+                    data = b''
+                penalty = LOSS_PENALTY if self.loss and self.random.random() < self.loss else 0
+                due = max(due, time.monotonic() + self.delay + penalty)
+                pending.put((due, data))
+                if not data:
+                    return
+
+        def write():
+            while True:
+                due, data = pending.get()
+                wait = due - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    if not data:
+                        sink.shutdown(socket.SHUT_WR)
+                        return
+                    sink.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+
+class ChunkTimer:
+    """Stands in for a transfer's share_queue and times the gaps between chunks.
+
+    Downloads report a chunk as it arrives and uploads as it is
+    acknowledged, so the gaps are the per-chunk service time with the ACK
+    window full. The size a download reports first is skipped.
+    """
+
+    def __init__(self, skip_first):
+        self.skip = skip_first
+        self.last = time.perf_counter()
+        self.gaps = []
+
+    def put(self, size):
+        if self.skip:
+            self.skip = False
+            self.last = time.perf_counter()
+            return
+        now = time.perf_counter()
+        self.gaps.append(now - self.last)
+        self.last = now
+
+
+class Phase:
+    """Timings of one operation across every client thread of a run."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.chunk_gaps = []
+        self.bytes = 0
+        self.errors = 0
+        self.started = self.cpu_started = None
+        self.elapsed = self.cpu = 0.0
+
+    def run(self, jobs):
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        threads = [threading.Thread(target=job, args=(self,)) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        self.cpu = time.process_time() - self.cpu_started
+
+    def record(self, seconds, size=0, gaps=(), ok=True):
+        with self.lock:
+            self.latencies.append(seconds)
+            self.chunk_gaps.extend(gaps)
+            self.bytes += size
+            self.errors += not ok
+
+    def summary(self):
+        ms = lambda value: None if value is None else round(value * 1000, 3)
+        return {
+            'operation': self.name,
+            'ops': len(self.latencies),
+            'errors': self.errors,
+            'seconds': round(self.elapsed, 3),
+            'mb_per_s': round(self.bytes / 1048576 / self.elapsed, 2) if self.bytes and self.elapsed else None,
+            'ops_per_s': round(len(self.latencies) / self.elapsed, 1) if self.elapsed else None,
+            'op_ms_p50': ms(percentile(self.latencies, 50)),
+            'op_ms_p99': ms(percentile(self.latencies, 99)),
+            'chunk_ms_p50': ms(percentile(self.chunk_gaps, 50)),
+            'chunk_ms_p99': ms(percentile(self.chunk_gaps, 99)),
+            'cpu_seconds': round(self.cpu, 3),
+        }
+
+
+def quiet_logging():
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)  # The client logs every chunk at INFO
+
+
+def run_isolated(*args):
+    """Run run_scenario(*args) in a new process and return its result."""
+    with multiprocessing.get_context('spawn').Pool(1, initializer=quiet_logging) as pool:
+        return pool.apply(run_scenario, args)
+
+
+def run_scenario(size, count, clients, rtt=0.0, loss=0.0, operations=('upload', 'list', 'download', 'delete'), client_options=None,
+                 server_options=None):
+    """Run every operation over count files of size bytes spread across clients threads; returns a result dict.
+
+    peak_rss_mb in the result is the peak of the whole process, so it only
+    describes this scenario when run through run_isolated.
+    """
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    source = os.path.join(workdir, 'source')
+    os.makedirs(source)
+    bench_server = server.Server('127.0.0.1', 0, os.path.join(workdir, 'server'), events.LoggingSink(),
+                                 **(server_options or {}))
+    bench_server.start()
+    port = bench_server.server_socket.getsockname()[1]
+    proxy = DelayProxy(port, rtt, loss) if rtt or loss else None
+    connections = []
+    try:
+        rng = random.Random(size)
+        paths = []
+        for index in range(count):
+            path = os.path.join(source, f"bench-{index:05d}.bin")
+            with open(path, 'wb') as f:
+                f.write(rng.randbytes(size))
+            paths.append(path)
+
+        for _ in range(clients):
+            conn = client.Client('127.0.0.1', proxy.port if proxy else port, **(client_options or {}))
+            conn.connect()
+            connections.append(conn)
+        shares = [paths[index::clients] for index in range(clients)]
+
+        def timed(phase, operation, size, chunk_timer=None):
+            start = time.perf_counter()
+            try:
+                ok = operation() is not False
+            except Exception as e:
+                logging.error(f"{phase.name} failed: {e}")
+                ok = False
+            phase.record(time.perf_counter() - start, size if ok else 0, chunk_timer.gaps if chunk_timer else (), ok)
+
+        def upload(conn, share):
+            def job(phase):
+                for path in share:
+                    timer = ChunkTimer(skip_first=False)
+                    timed(phase, lambda: conn.upload_file(path, True, timer), size, timer)
+            return job
+
+        def download(conn, share, destination):
+            def job(phase):
+                for path in share:
+                    timer = ChunkTimer(skip_first=True)
+                    timed(phase, lambda: conn.download_file(os.path.basename(path), destination, True, timer), size, timer)
+            return job
+
+        def listing(conn):
+            def job(phase):
+                for _ in range(LIST_REPEAT):
+                    timed(phase, conn.list, 0)
+            return job
+
+        def delete(conn, share):
+            def job(phase):
+                for path in share:
+                    timed(phase, lambda: conn.delete_file(os.path.basename(path)), 0)
+            return job
+
+        phases = []
+        for name in operations:
+            phase = Phase(name)
+            if name == 'upload':
+                jobs = [upload(conn, share) for conn, share in zip(connections, shares)]
+            elif name == 'download':
+                jobs = []
+                for index, (conn, share) in enumerate(zip(connections, shares)):
+                    destination = os.path.join(workdir, f"download-{index}")
+                    os.makedirs(destination, exist_ok=True)
+                    jobs.append(download(conn, share, destination))
+            elif name == 'list':
+                jobs = [listing(conn) for conn in connections]
+            elif name == 'delete':
+                jobs = [delete(conn, share) for conn, share in zip(connections, shares)]
+            else:
+                raise ValueError(f"unknown operation {name!r}")
+            phase.run(jobs)
+            phases.append(phase.summary())
+
+        return {'size': size, 'count': count, 'clients': clients, 'rtt_ms': rtt * 1000, 'loss': loss,
+                'peak_rss_mb': peak_rss_mb(), 'phases': phases}
+    finally:
+        for conn in connections:
+            conn.close()
+        if proxy:
+            proxy.close()
+        deadline = time.monotonic() + 2
+        while bench_server.client_count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        bench_server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_table(results, out=sys.stdout):
+    columns = ['size', 'clients', 'operation', 'ops', 'errors', 'mb_per_s', 'ops_per_s',
+               'op_ms_p50', 'op_ms_p99', 'chunk_ms_p50', 'chunk_ms_p99', 'cpu_seconds', 'peak_rss_mb']
+    rows = [[str(result['size']), str(result['clients'])] +
+            ['-' if phase[column] is None else str(phase[column]) for column in columns[2:-1]] +
+            [str(result['peak_rss_mb'])]
+            for result in results for phase in result['phases']]
+    widths = [max(len(column), *(len(row[index]) for row in rows)) for index, column in enumerate(columns)]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)), file=out)
+    for row in rows:
+        print('  '.join(cell.rjust(width) for cell, width in zip(row, widths)), file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback benchmark of uploads, downloads, listing and deletes")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated file sizes, with K/M/G suffixes")
+    parser.add_argument("--count", type=int, default=DEFAULT_COUNT, help="files per size")
+    parser.add_argument("--clients", default=DEFAULT_CLIENTS,
+                        help="comma-separated client counts to sweep, or a range such as 1-8")
+    parser.add_argument("--rtt", type=float, default=0.0, help="round-trip time to add through a local proxy, in ms")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of proxied reads delayed as if lost")
+    parser.add_argument("--operations", default="upload,list,download,delete")
+    parser.add_argument("--window", type=int, default=None, help="chunks in flight per transfer")
+    parser.add_argument("--digest", default=None, help="per-chunk digest to negotiate")
+    parser.add_argument("--compression", default=None, help="codec to negotiate")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON, '-' for stdout")
+    parser.add_argument("--same-process", action="store_true",
+                        help="run every scenario in this process, e.g. under a profiler; peak_rss_mb is then cumulative")
+    args = parser.parse_args()
+
+    quiet_logging()
+
+    if '-' in args.clients and ',' not in args.clients:
+        first, last = (int(n) for n in args.clients.split('-'))
+        sweep = list(range(first, last + 1))
+    else:
+        sweep = [int(n) for n in args.clients.split(',')]
+    client_options = {}
+    server_options = {}
+    if args.window:
+        client_options['window_size'] = args.window
+        server_options['window_size'] = args.window
+    if args.digest:
+        client_options['digest'] = args.digest
+    if args.compression:
+        client_options['compression'] = args.compression
+
+    run = run_scenario if args.same_process else run_isolated
+    results = []
+    for size in (parse_size(size) for size in args.sizes.split(',')):
+        for clients in sweep:
+            results.append(run(size, args.count, clients, args.rtt / 1000, args.loss,
+                               args.operations.split(','), client_options, server_options))
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
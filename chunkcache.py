@@ -0,0 +1,100 @@
+import os
+import threading
+from collections import OrderedDict
+import protocol
+
+# What repeat downloads of an unchanged file would otherwise compute again:
+# the parsed per-chunk digest sidecar and the compressed form of every
+# chunk. Entries are keyed by the file's path and (inode, size, mtime), so
+# a file changed behind the server's back never gets stale entries served;
+# the server also drops a path's entries whenever it replaces the file.
+CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+ENTRY_OVERHEAD = 200  # Rough bytes of bookkeeping per entry
+
+
+def file_version(path):
+    """Return (st_ino, st_size, st_mtime_ns) of path, or None if it is not a regular file."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ChunkCache:
+    """LRU of values keyed by (path, ...) tuples, bounded by the bytes they hold."""
+
+    def __init__(self, capacity=CHUNK_CACHE_BYTES):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # Key -> (value, size), least recently used first
+        self.paths = {}  # Path -> keys cached for it
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        size += ENTRY_OVERHEAD
+        if size > self.capacity:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.paths.setdefault(key[0], set()).add(key)
+            self.size += size
+            while self.size > self.capacity:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        _, size = self.entries.pop(key)
+        self.size -= size
+        keys = self.paths[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.paths[key[0]]
+
+    def invalidate(self, path):
+        """Drop everything cached for path."""
+        with self.lock:
+            for key in list(self.paths.get(path, ())):
+                self._remove(key)
+
+    def packed(self, path, version, codec, algorithm):
+        """Return the packed-chunk cache of one file for protocol.send_chunks."""
+        return PackedChunks(self, (path, version, codec, algorithm))
+
+
+class PackedChunks:
+    """The packed form of one file's chunks for one codec and digest, held in a ChunkCache.
+
+    Compressed payloads are kept. Chunks that did not shrink are sent raw,
+    so only their digest is kept and the data is taken from the file again.
+    """
+
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = prefix
+
+    def get(self, chunk_num, data):
+        entry = self.cache.get(self.prefix + (chunk_num,))
+        if entry is None:
+            return None
+        payload, flags, digest = entry
+        return protocol.PackedChunk(data, data if payload is None else payload, flags, digest)
+
+    def put(self, chunk_num, chunk):
+        payload = bytes(chunk.payload) if chunk.flags else None
+        self.cache.put(self.prefix + (chunk_num,), (payload, chunk.flags, chunk.digest),
+                       len(chunk.digest) + (len(payload) if payload else 0))
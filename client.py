@@ -1,144 +1,628 @@
+import io
 import socket
-import struct
 import os
+import time
+import tempfile
 import threading
-import hashlib
 import logging
-import time
-from customtkinter import *
-from tkinter import filedialog, messagebox
+from contextlib import contextmanager
+import protocol
+import dedup
+import delta
+import hashlib
+import json
+import batch
+import telemetry
 
 SERVER_IP = socket.gethostbyname(socket.gethostname())
 SERVER_PORT = 5000
+POOL_SIZE = 4  # Connections a ClientPool keeps open at most
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+class SkipProgress:
+    """share_queue stand-in for a transfer started over: passes put() sizes on once skip bytes have gone by.
+
+    What the first attempt reported stays shown and the bar only moves again
+    when the new attempt gets past it, so it never goes beyond the total.
+    """
+
+    def __init__(self, share_queue, skip):
+        self.share_queue = share_queue
+        self.skip = skip
+
+    def put(self, size):
+        skipped = min(size, self.skip)
+        self.skip -= skipped
+        if size > skipped:
+            self.share_queue.put(size - skipped)
+
 class Client:
     BUFFER_SIZE = 1024 * 1024
 
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, window_size=protocol.WINDOW_SIZE, digest=protocol.DEFAULT_DIGEST, file_digest=None, compression=None, metrics=None):
+        # digest is the per-chunk algorithm asked for (see protocol.DIGESTS); a
+        # cheap checksum plus a file_digest such as 'blake2b' keeps whole files
+        # verified without a cryptographic hash on every chunk. compression
+        # names a codec from protocol.CODECS for chunks that shrink.
         self.server_ip = server_ip
         self.server_port = server_port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.channel = protocol.Channel(self.client_socket)
         self.lock = threading.Lock()
+        self.window_size = window_size
+        self.digest = digest
+        self.file_digest = file_digest
+        self.compression = compression
+        self.metrics = metrics or telemetry.NULL_METRICS
 
     def connect(self):
-        self.client_socket.connect((self.server_ip, self.server_port))
+        with self.metrics.trace('connect', f"{self.server_ip}:{self.server_port}") as trace:
+            with trace.span('tcp'):
+                self.client_socket.connect((self.server_ip, self.server_port))
+                protocol.no_delay(self.client_socket)
+            with trace.span('hello'):
+                self.channel.request_version(digest=self.digest, file_digest=self.file_digest, codec=self.compression)
 
     def close(self):
         self.client_socket.close()
         
     def send_data(self, data):
-        data_len = len(data)
-        self.client_socket.sendall(struct.pack('!I', data_len))
-        self.client_socket.sendall(data)
+        protocol.send_data(self.client_socket, data)
 
     def receive_data(self):
-        data_len_bytes = self.client_socket.recv(4)
-        if not data_len_bytes:
-            return None
-        data_len = struct.unpack('!I', data_len_bytes)[0]
-        data = b''
-        while len(data) < data_len:
-            packet = self.client_socket.recv(data_len - len(data))
-            if not packet:
-                return None
-            data += packet
+        data = self.channel.receive_data()
+        if data is None:
+            raise ConnectionError("Connection closed by the server")
         return data
 
     def calculate_checksum(self, data):
-        return hashlib.sha256(data).hexdigest()
-
-    def send_chunk(self, chunk_num, chunk_data, ch = False, share_queue = None):
-        retries = 3  # Số lần thử lại tối đa
-        while retries > 0:
-            try:
-                checksum = self.calculate_checksum(chunk_data)
-                data_with_checksum_chunk_num = checksum.encode() + b'::' + str(chunk_num).encode() + b'::' + chunk_data
-                with self.lock:
-                    self.send_data(data_with_checksum_chunk_num)
-                    ack = self.receive_data()
-                    if ack.decode() == "ACK":
-                        if ch == True:
-                            share_queue.put(len(chunk_data))
-                        logging.info(f"Chunk {chunk_num} uploaded successfully.")
-                        return True  # Thành công, không cần thử lại nữa
-            except Exception as e:
-                logging.error(f"Error uploading chunk {chunk_num}: {e}")
-                retries -= 1
-        logging.error(f"Failed to upload chunk {chunk_num} after {retries} retries.")
-        return False
+        return protocol.calculate_checksum(data)
 
     def receive_chunk(self):
         retries = 3  # Số lần thử lại tối đa
         while retries > 0:
             try:
-                data_with_checksum = self.receive_data()
-                if data_with_checksum:
-                    received_checksum, chunk_num, chunk_data = data_with_checksum.split(b'::', 2)
-                    calculated_checksum = self.calculate_checksum(chunk_data)
-                    if received_checksum.decode() == calculated_checksum:
-                        self.send_data(b"ACK")
-                        logging.info(f"Chunk {chunk_num.decode()} received successfully.")
-                        return chunk_num, chunk_data
+                frame = self.channel.receive_frame()
+                if frame is None:
+                    break
+                chunk = protocol.decode_chunk(frame, self.channel.digest, self.channel.codec)
+                if chunk.msg_type == protocol.MSG_ABORT:
+                    logging.error("Sender aborted the transfer.")
+                    break
+                if chunk.valid:
+                    # END frames are acknowledged by receive_chunks once the file is checked.
+                    if chunk.msg_type != protocol.MSG_END:
+                        self.channel.send_ack(chunk, True)
+                        logging.info(f"Chunk {chunk.chunk_num} received successfully.")
+                    return chunk
+                self.metrics.checksum_failures.inc()
+                logging.warning(f"Checksum mismatch on chunk {chunk.chunk_num}, requesting retransmission.")
+                self.channel.send_ack(chunk, False)
+            except ValueError as e:
+                self.metrics.checksum_failures.inc()
+                logging.error(f"Malformed chunk: {e}")
+                self.send_data(b"NAK")
             except Exception as e:
                 logging.error(f"Error receiving chunk: {e}")
-                retries -= 1
-        logging.error(f"Failed to receive chunk after {retries} retries.")
+                break
+            retries -= 1
+        logging.error("Failed to receive chunk, closing the connection.")
+        self.channel.abort()
         return None
 
-    def upload_file(self, filepath, ch = False, share_queue = None):
-        self.send_data(b'u')
-        self.send_data(os.path.basename(filepath).encode())
+    def receive_chunks(self, f, ch = False, share_queue = None, manifest = None, verifier = None, write = None, trace = telemetry.NULL):
+        """Write incoming chunks to their offsets in f until the end frame; returns False on failure.
 
-        threads = []
-        with open(filepath, 'rb') as f:
-            chunk_num = 0
-            while True:
-                chunk_data = f.read(self.BUFFER_SIZE)
-                if not chunk_data:
-                    time.sleep(0.2)
-                    thread = threading.Thread(target=self.send_chunk, args=(chunk_num, "".encode()))
-                    thread.start()
-                    threads.append(thread)
-                    break
-                #time.sleep(0.5)
-                thread = threading.Thread(target=self.send_chunk, args=(chunk_num, chunk_data, ch, share_queue))
-                thread.start()
-                threads.append(thread)
-                chunk_num += 1
+        write(chunk_num, payload), if given, takes the chunks instead of f.
+        The end frame must carry the number of chunks that arrived.
+        """
+        chunk_count = 0
+        transfer_id = None
+        timing = trace is not telemetry.NULL
+        while True:
+            if timing:
+                start = time.perf_counter()
+            chunk = self.receive_chunk()
+            if chunk is None:
+                return False
+            if transfer_id is None:
+                transfer_id = chunk.transfer_id
+            elif chunk.transfer_id != transfer_id:
+                logging.error(f"Chunk {chunk.chunk_num} belongs to transfer {chunk.transfer_id}, expected {transfer_id}.")
+                self.channel.abort()
+                return False
+            if chunk.msg_type == protocol.MSG_END:
+                if chunk.chunk_num != chunk_count:
+                    logging.error(f"Sender reports {chunk.chunk_num} chunks, {chunk_count} arrived.")
+                    self.channel.send_ack(chunk, False)
+                    return False
+                if verifier and chunk.digest:
+                    with trace.span('verify'):
+                        verified = verifier.verify(chunk.digest, f, self.BUFFER_SIZE)
+                    if not verified:
+                        logging.error(f"Whole-file {verifier.algorithm} digest mismatch, discarding received chunks.")
+                        self.channel.send_ack(chunk, False)
+                        if manifest:
+                            manifest.reset(manifest.filesize)
+                        return False
+                self.channel.send_ack(chunk, True)
+                return True
+            if ch == True:
+                share_queue.put(len(chunk.payload))
+            # time.sleep(0.5)
+            if write:
+                write(chunk.chunk_num, chunk.payload)
+            else:
+                f.seek(chunk.chunk_num * self.BUFFER_SIZE)
+                f.write(chunk.payload)
+            if manifest:
+                manifest.add(chunk.chunk_num)
+            if verifier:
+                verifier.update(chunk.chunk_num, chunk.payload)
+            self.metrics.bytes_received.inc(len(chunk.payload))
+            if timing:
+                trace.record('chunk', start)
+            chunk_count += 1
 
-        for thread in threads:
-            thread.join()
+    def send_chunks(self, f, ch = False, share_queue = None, first_chunk=0, last_chunk=None, ranges=None, trace=None):
+        def on_ack(chunk_num, chunk_data):
+            if ch == True:
+                share_queue.put(len(chunk_data))
+            logging.info(f"Chunk {chunk_num} uploaded successfully.")
+
+        file_hash = None
+        if ranges is not None:
+            chunks = protocol.read_ranges(f, self.BUFFER_SIZE, ranges)
+        else:
+            chunks = protocol.read_chunks(f, self.BUFFER_SIZE, first_chunk, last_chunk)
+            if first_chunk == 0 and last_chunk is None:
+                file_hash = self.channel.new_file_hash()
+        with self.lock:
+            protocol.send_chunks(self.channel, chunks, self.window_size, on_ack, file_hash, protocol.should_compress(f.name),
+                                 observe=self.metrics.observer(trace))
+
+    def missing_chunks(self, filepath, filename, filesize):
+        """Return the chunk ranges the server lacks, or None while another client is resuming filename."""
+        self.send_data(b'm')
+        if self.channel.version >= 2:
+            # Chunks kept from another version of the file are dropped by the server.
+            self.send_data(f"{filename}::{filesize}::{os.stat(filepath).st_mtime_ns}".encode())
+        else:
+            self.send_data(f"{filename}::{filesize}".encode())
+        reply = self.receive_data()
+        if reply == b'File busy.':
+            return None
+        return protocol.decode_ranges(reply)
+
+    def upload_file(self, filepath, ch = False, share_queue = None, connections = 0, resume = False, deduplicate = False, delta_sync = False, skip_identical = False):
+        if skip_identical and self.is_identical(filepath, os.path.basename(filepath)):
+            if ch == True:
+                share_queue.put(os.path.getsize(filepath))
+            logging.info(f"File {os.path.basename(filepath)} is already on the server, upload skipped.")
+            return True
+        if delta_sync and os.path.getsize(filepath) >= delta.MIN_SIZE:
+            if self.channel.version >= 2:
+                return self.delta_upload(filepath, ch, share_queue)
+            logging.warning("Server does not support delta uploads, sending the whole file.")
+        if deduplicate:
+            if dedup.numpy is None:
+                logging.warning("Deduplicated uploads need numpy to chunk files quickly, sending the whole file.")
+            elif self.channel.version >= 2:
+                return self.deduplicated_upload(filepath, ch, share_queue)
+            else:
+                logging.warning("Server does not support deduplicated uploads, sending the whole file.")
+        if connections > 0:
+            return self.parallel_upload(filepath, connections, ch, share_queue)
+
+        filename = os.path.basename(filepath)
+        ranges = None
+        if resume:
+            # Ask the server which chunks it still lacks and send only those.
+            filesize = os.path.getsize(filepath)
+            ranges = self.missing_chunks(filepath, filename, filesize)
+            if ranges is None:
+                logging.error(f"Another upload of {filename} is being resumed, try again later.")
+                return False
+            missing_size = sum(min(last * self.BUFFER_SIZE, filesize) - first * self.BUFFER_SIZE for first, last in ranges)
+            if ch == True:
+                share_queue.put(filesize - missing_size)
+            self.send_data(b'a')
+        else:
+            self.send_data(b'u')
+        self.send_data(filename.encode())
+        try:
+            with self.metrics.transfer('resume_upload' if resume else 'upload', filename) as trace, open(filepath, 'rb') as f:
+                self.send_chunks(f, ch, share_queue, ranges=ranges, trace=trace)
+        except ConnectionError as e:
+            logging.error(f"Upload of {filename} failed: {e}")
+            return False
+        # Version 2 servers confirm once the file is in place.
+        if self.channel.version >= 2 and self.receive_data() != b"success":
+            logging.error(f"Server could not store {filename}{', chunks are still missing' if resume else ''}.")
+            return False
+        # Resuming only checks the size, so kept chunks may come from an older
+        # version of the file; if the result differs, send the whole file.
+        if resume and self.channel.version >= 2 and not self.is_identical(filepath, filename):
+            logging.warning(f"Resumed upload of {filename} does not match the local file, uploading it again.")
+            return self.upload_file(filepath, ch, SkipProgress(share_queue, os.path.getsize(filepath)) if ch == True else share_queue)
 
-        logging.info(f"File {os.path.basename(filepath)} uploaded successfully.")
+        logging.info(f"File {filename} uploaded successfully.")
+        return True
 
-    def download_file(self, filename, destination, ch = False, share_queue = None):
-        self.send_data(b'd')
+    def deduplicated_upload(self, filepath, ch = False, share_queue = None):
+        """Upload filepath as content-defined chunks, sending only those the server does not hold.
+
+        Without numpy the chunking runs at a few MB/s, slower than sending the
+        file, so upload_file only comes here when numpy is installed.
+        """
+        filename = os.path.basename(filepath)
+        with open(filepath, 'rb') as f:
+            recipe = dedup.Recipe.from_file(f)
+        self.send_data(b'k')
         self.send_data(filename.encode())
-        filesize = self.receive_data().decode()
+        self.send_data(recipe.encode())
+        missing = protocol.decode_ranges(self.receive_data())
+        offsets = recipe.offsets()
         if ch == True:
-            share_queue.put(int(filesize))
+            new_size = sum(recipe.entries[index][1] for first, last in missing for index in range(first, last))
+            share_queue.put(recipe.size - new_size)
 
-        file_chunks = []
-        while True:
-            chunk_num, chunk_data = self.receive_chunk()
-            if not chunk_data:
-                break
+        def on_ack(chunk_num, chunk_data):
             if ch == True:
                 share_queue.put(len(chunk_data))
-            # time.sleep(0.5)
-            file_chunks.append((int(chunk_num.decode()), chunk_data))
+            logging.info(f"Chunk {chunk_num} uploaded successfully.")
+
+        with open(filepath, 'rb') as f:
+            def chunks():
+                for first, last in missing:
+                    for index in range(first, last):
+                        f.seek(offsets[index])
+                        yield index, f.read(recipe.entries[index][1])
+
+            with self.lock:
+                sent = protocol.send_chunks(self.channel, chunks(), self.window_size, on_ack, compress=protocol.should_compress(filename))
+
+        if self.receive_data() == b"success":
+            logging.info(f"File {filename} uploaded successfully, {sent} of {len(recipe.entries)} chunks were new.")
+            return True
+        logging.error(f"Failed to upload file {filename}.")
+        return False
+
+    def delta_upload(self, filepath, ch = False, share_queue = None):
+        """Overwrite a file on the server by sending only what differs from its copy."""
+        filename = os.path.basename(filepath)
+        self.send_data(b'y')
+        self.send_data(filename.encode())
+        response = self.receive_data()
+        if response == b'File not found.':
+            logging.info(f"File {filename} is not on the server yet, sending the whole file.")
+            return self.upload_file(filepath, ch, share_queue)
+        block_size, old_size = (int(n) for n in response.decode().split('::'))
+        signatures = delta.Signatures(self.receive_data(), block_size, old_size)
+
+        covered = {}
+        sent = 0
+        reported = 0
+        new_bytes = 0
+        filesize = os.path.getsize(filepath)
+        abandoned = False
+
+        def on_ack(chunk_num, chunk_data):
+            nonlocal sent, reported
+            length = covered.pop(chunk_num)
+            if ch == True:
+                share_queue.put(length)
+                reported += length
+            if chunk_data[:1] == b'D':
+                sent += length
+
+        file_hash = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            def ops():
+                nonlocal new_bytes, abandoned
+                for chunk_num, (op, length) in enumerate(delta.delta_ops(f, signatures, file_hash)):
+                    if op[:1] == b'D':
+                        new_bytes += length
+                        # Mostly new content is cheaper to send whole than to keep scanning.
+                        if new_bytes > filesize * delta.MAX_NEW_FRACTION:
+                            abandoned = True
+                            return
+                    covered[chunk_num] = length
+                    yield chunk_num, op
+
+            with self.lock:
+                protocol.send_chunks(self.channel, ops(), self.window_size, on_ack, compress=protocol.should_compress(filename))
+        if abandoned:
+            self.send_data(f"{filesize}::".encode())
+            self.receive_data()
+            logging.info(f"File {filename} changed too much for a delta, sending the whole file.")
+            return self.upload_file(filepath, ch, SkipProgress(share_queue, reported) if ch == True else share_queue)
+        self.send_data(f"{filesize}::{file_hash.hexdigest()}".encode())
+
+        if self.receive_data() == b"success":
+            logging.info(f"File {filename} updated successfully, {sent} new bytes sent.")
+            return True
+        logging.error(f"Failed to update file {filename}.")
+        return False
+
+    def hidden_path(self, filepath, suffix):
+        """Return the path of the dot-file .<name>.<suffix> beside filepath, creating its folder if needed.
+
+        Server names may contain folders ("dir/name"), which are created under the destination.
+        """
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f".{os.path.basename(filepath)}.{suffix}")
+
+    def download_file(self, filename, destination, ch = False, share_queue = None, connections = 0, resume = False, skip_identical = False):
+        local_path = os.path.join(destination, filename)
+        if skip_identical and os.path.isfile(local_path) and self.is_identical(local_path, filename):
+            if ch == True:
+                share_queue.put(os.path.getsize(local_path))
+                share_queue.put(os.path.getsize(local_path))
+            logging.info(f"File {filename} is already up to date, download skipped.")
+            return True
+        if connections > 0:
+            return self.parallel_download(filename, destination, connections, ch, share_queue)
 
+        self.send_data(b'g' if resume else b'd')
+        self.send_data(filename.encode())
+        reply = self.receive_data()
+        if reply == b'File not found.':
+            logging.error(f"File {filename} not found on the server.")
+            return False
+        filesize = int(reply.decode())
+        if ch == True:
+            share_queue.put(filesize)
 
+        # Write each chunk at its offset as it arrives instead of buffering the
+        # whole download in memory. The manifest lets a later call with
+        # resume=True fetch only the chunks that are still missing.
         filepath = os.path.join(destination, filename)
-        with open(filepath, 'wb') as f:
-            for chunk_num, chunk_data in sorted(file_chunks):
-                f.write(chunk_data)
+        temp_path = self.hidden_path(filepath, 'part')
+        manifest = protocol.ChunkManifest(self.hidden_path(filepath, 'manifest'))
+        if resume and os.path.exists(temp_path) and manifest.filesize == filesize:
+            mode = 'r+b'
+        else:
+            mode = 'w+b'
+            manifest.reset(filesize)
+        # Ranged downloads get no whole-file digest, only full ones are checked.
+        verifier = protocol.FileVerifier(self.channel.file_digest) if self.channel.file_digest and not resume else None
+        if resume:
+            if ch == True:
+                share_queue.put(min(len(manifest.chunks) * self.BUFFER_SIZE, filesize))
+            self.send_data(protocol.encode_ranges(manifest.missing(self.BUFFER_SIZE)))
+
+        with self.metrics.transfer('resume_download' if resume else 'download', filename) as trace, open(temp_path, mode) as f:
+            completed = self.receive_chunks(f, ch, share_queue, manifest, verifier, trace=trace)
+            if completed:
+                f.truncate(filesize)
 
+        if not completed or not manifest.is_complete(self.BUFFER_SIZE):
+            logging.error(f"Download of {filename} interrupted, {len(manifest.chunks)} chunks kept for resume.")
+            return False
+
+        manifest.remove()
+        # Resuming only checks the size, so kept chunks may come from an older
+        # version of the server's file; if the result differs, fetch it whole.
+        if resume and self.channel.version >= 2:
+            stat = self.stat(filename, digest=True)
+            with open(temp_path, 'rb') as f:
+                matched = stat is not None and delta.file_digest(f) == stat['digest']
+            if not matched:
+                os.remove(temp_path)
+                logging.warning(f"Resumed download of {filename} does not match the server copy, downloading it again.")
+                return self.download_file(filename, destination, ch, share_queue)
+        os.replace(temp_path, filepath)
         logging.info(f"File {os.path.basename(filename)} received successfully.")
+        return True
+
+    def read_ranges(self, filename, ranges, f = None):
+        """Fetch byte ranges of filename in one request; returns their bytes back to back, or the count written to f.
+
+        ranges is [(offset, length), ...], a negative offset counting from
+        the end of the file and a length of None reading to the end; ranges
+        past the end come back shorter. With f, a seekable binary file, the
+        bytes are written from its current position instead of returned.
+        Returns None if the file is not on the server or the transfer failed.
+        """
+        if self.channel.version < 2:
+            logging.warning("Server does not support ranged reads, downloading the whole file.")
+            return self.read_ranges_from_copy(filename, ranges, f)
+        self.send_data(b'p')
+        self.send_data(json.dumps({'name': filename, 'ranges': [list(r) for r in ranges]}).encode())
+        reply = self.receive_data()
+        if reply == b'File not found.':
+            return None
+        total = sum(length for _, length in json.loads(reply)['ranges'])
+
+        target = io.BytesIO() if f is None else f
+        start = target.tell()
+
+        def write(chunk_num, payload):
+            target.seek(start + chunk_num * self.BUFFER_SIZE)
+            target.write(payload)
+
+        verifier = protocol.FileVerifier(self.channel.file_digest, start, total) if self.channel.file_digest else None
+        with self.metrics.transfer('range', filename) as trace:
+            completed = self.receive_chunks(target, verifier=verifier, write=write, trace=trace)
+        if not completed:
+            logging.error(f"Ranged read of {filename} failed.")
+            return None
+        target.seek(start + total)
+        return target.getvalue() if f is None else total
+
+    def read_range(self, filename, offset, length = None, f = None):
+        """Fetch length bytes of filename from offset, or up to its end; see read_ranges."""
+        return self.read_ranges(filename, [(offset, length)], f)
+
+    def read_ranges_from_copy(self, filename, ranges, f = None):
+        with tempfile.TemporaryDirectory() as destination:
+            if not self.download_file(filename, destination):
+                return None
+            parts = []
+            with open(os.path.join(destination, filename), 'rb') as copy:
+                filesize = os.fstat(copy.fileno()).st_size
+                for offset, length in ranges:
+                    copy.seek(min(max(filesize + offset, 0) if offset < 0 else offset, filesize))
+                    parts.append(copy.read() if length is None else copy.read(max(0, length)))
+        data = b''.join(parts)
+        if f is None:
+            return data
+        f.write(data)
+        return len(data)
+
+    def upload_many(self, directory, ch = False, share_queue = None):
+        """Upload every file under directory as one batch, keeping the folder structure on the server.
+
+        The files go out back to back in one chunk stream, so small files
+        share chunks and there is no per-file round trip. Returns True if
+        the server stored them all.
+        """
+        manifest = batch.walk_files(directory)
+        self.send_data(b'b')
+        self.send_data(json.dumps(manifest).encode())
+        response = self.receive_data()
+        if response != b"ok":
+            logging.error(f"Server refused the batch: {response.decode()}")
+            return False
+
+        def on_ack(chunk_num, chunk_data):
+            if ch == True:
+                share_queue.put(len(chunk_data))
+
+        files = [(os.path.join(directory, *relpath.split('/')), size) for relpath, size in manifest]
+        # Chunks made mostly of already compressed files are sent as they are.
+        worth = batch.compressible_chunks(manifest, self.BUFFER_SIZE)
+        with batch.ConcatReader(files) as f, self.lock:
+            chunks = protocol.compress_selected(protocol.read_chunks(f, self.BUFFER_SIZE), worth, self.channel.digest)
+            protocol.send_chunks(self.channel, chunks, self.window_size, on_ack, compress=any(worth))
+
+        if self.receive_data() == b"success":
+            logging.info(f"Uploaded {len(manifest)} files from {directory}.")
+            return True
+        logging.error(f"Failed to upload the files from {directory}.")
+        return False
+
+    def download_many(self, names, destination, ch = False, share_queue = None):
+        """Download the named server files as one batch into destination, recreating their folders.
+
+        Returns the names that were downloaded; names the server does not
+        have are left out.
+        """
+        self.send_data(b'f')
+        self.send_data(json.dumps(list(names)).encode())
+        manifest = json.loads(self.receive_data())
+        writer = batch.BatchWriter(destination, manifest, self.BUFFER_SIZE)
+        writer.prepare()
+        if ch == True:
+            share_queue.put(writer.total)
+
+        try:
+            completed = self.receive_chunks(None, ch, share_queue, write = writer.write)
+        finally:
+            writer.close()
+        if not completed:
+            writer.abort()
+            logging.error(f"Download of {len(manifest)} files interrupted.")
+            return []
+        writer.commit()
+        logging.info(f"Downloaded {len(manifest)} files into {destination}.")
+        return [name for name, _ in manifest]
+
+    def open_session(self, request):
+        self.send_data(b'o')
+        self.send_data(request.encode())
+        response = self.receive_data()
+        if response == b'File not found.':
+            raise FileNotFoundError(request)
+        session_id, filesize = response.decode().split('::')
+        return session_id, int(filesize)
+
+    def close_session(self, session_id):
+        self.send_data(b'c')
+        self.send_data(session_id.encode())
+        return self.receive_data() == b"success"
+
+    def run_data_connections(self, session_id, ranges, transfer):
+        """Open one extra connection per chunk range, join it to the session and run transfer(conn, first, last) on it."""
+        errors = []
+
+        def worker(first_chunk, last_chunk):
+            conn = Client(self.server_ip, self.server_port, self.window_size, self.digest, compression=self.compression, metrics=self.metrics)
+            try:
+                conn.connect()
+                conn.send_data(b'j')
+                conn.send_data(f"{session_id}::{first_chunk}::{last_chunk}".encode())
+                if not transfer(conn, first_chunk, last_chunk):
+                    errors.append((first_chunk, last_chunk))
+            except Exception as e:
+                logging.error(f"Error transferring chunks {first_chunk}-{last_chunk - 1}: {e}")
+                errors.append((first_chunk, last_chunk))
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=worker, args=chunk_range) for chunk_range in ranges]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return not errors
+
+    def parallel_upload(self, filepath, connections, ch = False, share_queue = None):
+        filename = os.path.basename(filepath)
+        filesize = os.path.getsize(filepath)
+        session_id, _ = self.open_session(f"u::{filename}::{filesize}")
+
+        def transfer(conn, first_chunk, last_chunk):
+            with open(filepath, 'rb') as f:
+                conn.send_chunks(f, ch, share_queue, first_chunk, last_chunk)
+            return True
+
+        ranges = protocol.split_ranges(filesize, self.BUFFER_SIZE, connections)
+        self.run_data_connections(session_id, ranges, transfer)
+        if self.close_session(session_id):
+            logging.info(f"File {filename} uploaded successfully over {len(ranges)} connections.")
+            return True
+        logging.error(f"Failed to upload file {filename}.")
+        return False
+
+    def parallel_download(self, filename, destination, connections, ch = False, share_queue = None):
+        try:
+            session_id, filesize = self.open_session(f"d::{filename}")
+        except FileNotFoundError:
+            logging.error(f"File {filename} not found on the server.")
+            return False
+        if ch == True:
+            share_queue.put(filesize)
+
+        filepath = os.path.join(destination, filename)
+        temp_path = self.hidden_path(filepath, 'part')
+        with open(temp_path, 'wb') as f:
+            f.truncate(filesize)
+
+        def transfer(conn, first_chunk, last_chunk):
+            with open(temp_path, 'r+b') as f:
+                return conn.receive_chunks(f, ch, share_queue)
+
+        ranges = protocol.split_ranges(filesize, self.BUFFER_SIZE, connections)
+        completed = self.run_data_connections(session_id, ranges, transfer)
+        self.close_session(session_id)
+        if not completed:
+            os.remove(temp_path)
+            logging.error(f"Failed to download file {filename}.")
+            return False
+
+        os.replace(temp_path, filepath)
+        logging.info(f"File {filename} received successfully over {len(ranges)} connections.")
+        return True
 
     def list(self):
+        if self.channel.version >= 2:
+            return [(name, str(size)) for name, size, _ in self.list_pages()]
+
         list_file = []
         try:
             self.send_data(b'r')
@@ -151,18 +635,175 @@ class Client:
             list_file.append((file_name.decode(), file_size.decode()))
         return list_file
 
+    def stat(self, filename, digest = False):
+        """Return {"name", "size", "mtime", "digest"} for one server file, or None if it does not exist.
+
+        With digest=True the server fills in the SHA-256 of the content,
+        hashing the file if it has not done so since it last changed.
+        Version 1 servers only report the size, found through the list.
+        """
+        if self.channel.version < 2:
+            size = next((size for name, size in self.list() if name == filename), None)
+            return None if size is None else {'name': filename, 'size': int(size), 'mtime': None, 'digest': None}
+        self.send_data(b's')
+        self.send_data(json.dumps({'name': filename, 'digest': digest}).encode())
+        reply = self.receive_data()
+        if reply == b'File not found.':
+            return None
+        return json.loads(reply)
+
+    def is_identical(self, local_path, filename):
+        """Whether the server copy of filename has the same content as local_path."""
+        stat = self.stat(filename)
+        if stat is None or stat['size'] != os.path.getsize(local_path):
+            return False
+        stat = self.stat(filename, digest=True)
+        if not stat or stat['digest'] is None:
+            return False
+        with open(local_path, 'rb') as f:
+            return delta.file_digest(f) == stat['digest']
+
+    def list_pages(self, prefix='', page_size=1000):
+        """Yield (name, size, mtime_ns) for the server files starting with prefix, a page at a time."""
+        after = ''
+        while True:
+            self.send_data(b'l')
+            self.send_data(json.dumps({'prefix': prefix, 'after': after, 'limit': page_size}).encode())
+            reply = json.loads(self.receive_data())
+            for name, size, mtime in reply['files']:
+                yield name, size, mtime
+            after = reply['next']
+            if after is None:
+                return
+
     def delete_file(self, filename):
         try:
             self.send_data(b'x')
         except Exception as e :
             logging.error(f"Error connecting: {e}")
-            return
+            raise
         self.send_data(filename.encode())
         response = self.receive_data()
         if response.decode() == "success":
             logging.info(f"Deleted file: {filename}")
-        else:
-            logging.error(f"Failed to delete file: {filename}")
+            return True
+        logging.error(f"Failed to delete file: {filename}")
+        return False
+
+
+class ClientPool:
+    """Connections to one server, each carrying one operation at a time.
+
+    A Client speaks one request at a time on its socket, so operations that
+    overlap, such as listing the folder while a download runs, each check
+    out a connection of their own instead of interleaving frames. Idle
+    connections are kept for reuse; one that raised is closed rather than
+    put back. Requests that are safe to repeat are retried once on a fresh
+    connection, so a restarted server does not surface as an error. The
+    options are passed on to every Client.
+    """
+
+    def __init__(self, server_ip, server_port, size=POOL_SIZE, **options):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.options = options
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        self.closed = False
+
+    def connect(self):
+        """Open the first connection, raising if the server cannot be reached."""
+        with self.connection():
+            pass
+
+    def new_connection(self):
+        conn = Client(self.server_ip, self.server_port, **self.options)
+        try:
+            conn.connect()
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the with block, waiting if all are busy."""
+        self.slots.acquire()
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.new_connection()
+            try:
+                yield conn
+            except BaseException:
+                # The stream may be left mid-reply, so the connection cannot be reused.
+                conn.close()
+                raise
+            with self.lock:
+                if not self.closed:
+                    self.idle.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+        finally:
+            self.slots.release()
+
+    def discard_idle(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def call(self, name, *args, retry=False, **kwargs):
+        """Run Client.<name> on a pooled connection."""
+        try:
+            with self.connection() as conn:
+                return getattr(conn, name)(*args, **kwargs)
+        except OSError as e:
+            if not retry:
+                raise
+            # Whatever broke this connection most likely broke the idle ones too.
+            self.discard_idle()
+            logging.warning(f"Connection lost ({e}), retrying {name} on a new connection.")
+        with self.connection() as conn:
+            return getattr(conn, name)(*args, **kwargs)
+
+    def list(self):
+        return self.call('list', retry=True)
+
+    def stat(self, filename, digest = False):
+        return self.call('stat', filename, digest, retry=True)
+
+    def is_identical(self, local_path, filename):
+        return self.call('is_identical', local_path, filename, retry=True)
+
+    def read_range(self, filename, offset, length = None, f = None):
+        return self.call('read_range', filename, offset, length, f, retry=f is None)
+
+    def read_ranges(self, filename, ranges, f = None):
+        return self.call('read_ranges', filename, ranges, f, retry=f is None)
+
+    def delete_file(self, filename):
+        return self.call('delete_file', filename)
+
+    def upload_file(self, *args, **kwargs):
+        return self.call('upload_file', *args, **kwargs)
+
+    def download_file(self, *args, **kwargs):
+        return self.call('download_file', *args, **kwargs)
+
+    def upload_many(self, *args, **kwargs):
+        return self.call('upload_many', *args, **kwargs)
+
+    def download_many(self, *args, **kwargs):
+        return self.call('download_many', *args, **kwargs)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.discard_idle()
 
 if __name__ == "__main__":
     client = Client(SERVER_IP, SERVER_PORT)
@@ -0,0 +1,83 @@
+import time
+import threading
+import protocol
+
+# Per-connection state of the threaded server, looked up by socket in O(1).
+# Each Connection is only written by its own handler thread apart from the
+# stats, which other threads may read through snapshot(); the registry lock
+# is held just long enough to add or remove an entry.
+
+
+class Connection:
+    """One accepted client socket: its address, channel, stats and current transfer."""
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.channel = protocol.Channel(sock)
+        self.connected_at = time.time()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.transfers = 0
+        self.transfer = None  # (kind, name) while a transfer runs
+        self.lock = threading.Lock()
+
+    @property
+    def label(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def received(self, size):
+        with self.lock:
+            self.bytes_received += size
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_sent += size
+
+    def begin(self, kind, name):
+        with self.lock:
+            self.transfer = (kind, name)
+            self.transfers += 1
+
+    def end(self):
+        with self.lock:
+            self.transfer = None
+
+    def snapshot(self):
+        with self.lock:
+            return {'address': self.label, 'connected_at': self.connected_at, 'bytes_received': self.bytes_received,
+                    'bytes_sent': self.bytes_sent, 'transfers': self.transfers, 'transfer': self.transfer}
+
+
+class ConnectionRegistry:
+    """Socket -> Connection for every client connection being served."""
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def add(self, sock, address):
+        connection = Connection(sock, address)
+        with self.lock:
+            self.connections[sock] = connection
+        return connection
+
+    def remove(self, sock):
+        with self.lock:
+            return self.connections.pop(sock, None)
+
+    def __getitem__(self, sock):
+        return self.connections[sock]
+
+    def get(self, sock):
+        return self.connections.get(sock)
+
+    def __len__(self):
+        return len(self.connections)
+
+    def all(self):
+        with self.lock:
+            return list(self.connections.values())
+
+    def snapshot(self):
+        return [connection.snapshot() for connection in self.all()]
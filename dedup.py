@@ -0,0 +1,358 @@
+import os
+import bisect
+import random
+import hashlib
+import threading
+from contextlib import contextmanager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Content-defined chunking with a gear rolling hash: a chunk ends where the
+# hash of the bytes just before it has its top CHUNK_BITS bits clear, so an
+# insertion only moves the boundaries next to it and identical content in
+# different files cuts into identical chunks. MAX_CHUNK keeps every chunk
+# within one protocol frame. numpy is optional: without it the cut points
+# are found byte by byte in Python, which is correct but only runs at a
+# few MB/s, so clients then upload whole files instead.
+MIN_CHUNK = 64 * 1024
+CHUNK_BITS = 18  # Average chunk of about MIN_CHUNK + 256 KiB
+MAX_CHUNK = 1024 * 1024
+CHUNK_MASK = ((1 << CHUNK_BITS) - 1) << (64 - CHUNK_BITS)
+READ_SIZE = 4 * 1024 * 1024
+SCAN_BLOCK = 64 * 1024  # Bytes hashed per numpy pass, so an early cut wastes little work
+
+_random = random.Random(0x6765617221)  # Fixed so every client cuts the same content the same way
+GEAR = [_random.getrandbits(64) for _ in range(256)]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy else None
+
+STORE_DIR = '.chunks'
+
+
+def find_cut(data, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask=CHUNK_MASK):
+    """Return the length of the chunk at the start of data, any bytes-like object."""
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    if numpy is not None:
+        return _find_cut_numpy(data, min_size, end, mask)
+    gear = GEAR
+    h = 0
+    position = min_size
+    for byte in memoryview(data)[min_size:end]:
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFFFFFFFFFF
+        position += 1
+        if not h & mask:
+            return position
+    return end
+
+
+def _find_cut_numpy(data, min_size, end, mask):
+    # A shift drops a byte's gear value out of the 64-bit hash after 64
+    # steps, so the hash at each offset is the sum of the last 64 values
+    # shifted by their distance, computed for a whole block by doubling.
+    values = numpy.frombuffer(data, dtype=numpy.uint8, count=end)
+    mask = numpy.uint64(mask)
+    for start in range(min_size, end, SCAN_BLOCK):
+        stop = min(start + SCAN_BLOCK, end)
+        first = max(min_size, start - 63)  # The hash starts from zero at min_size
+        h = GEAR_ARRAY[values[first:stop]]
+        for shift in (1, 2, 4, 8, 16, 32):
+            h[shift:] += h[:-shift] << numpy.uint64(shift)
+        cuts = numpy.flatnonzero((h[start - first:] & mask) == 0)
+        if len(cuts):
+            return start + int(cuts[0]) + 1
+    return end
+
+
+def chunk_stream(f, min_size=MIN_CHUNK, max_size=MAX_CHUNK, mask=CHUNK_MASK):
+    """Yield the content-defined chunks of f as bytes."""
+    buffer = bytearray()
+    offset = 0  # Start of the next chunk in buffer
+    eof = False
+    while True:
+        if not eof and len(buffer) - offset < max_size:
+            # Cut chunks are dropped once per read, not once per chunk.
+            del buffer[:offset]
+            offset = 0
+            while not eof and len(buffer) < max_size:
+                data = f.read(READ_SIZE)
+                eof = not data
+                buffer += data
+        if offset == len(buffer):
+            return
+        with memoryview(buffer) as view:
+            cut = find_cut(view[offset:], min_size, max_size, mask)
+            chunk = bytes(view[offset:offset + cut])
+        offset += cut
+        yield chunk
+
+
+class Recipe:
+    """The ordered chunks a deduplicated file is made of, as (sha256 hex, length) pairs.
+
+    The encoded form, used both on the wire and in the .<name>.recipe file,
+    is the file size on the first line and "<sha256> <length>" per chunk.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.size = sum(length for _, length in entries)
+
+    @classmethod
+    def from_file(cls, f):
+        return cls([(hashlib.sha256(chunk).hexdigest(), len(chunk)) for chunk in chunk_stream(f)])
+
+    @classmethod
+    def decode(cls, data):
+        lines = data.decode().splitlines()
+        entries = [(digest, int(length)) for digest, length in (line.split() for line in lines[1:])]
+        recipe = cls(entries)
+        if recipe.size != int(lines[0]):
+            raise ValueError(f"recipe chunks add up to {recipe.size} bytes, header says {lines[0]}")
+        return recipe
+
+    def encode(self):
+        return f"{self.size}\n".encode() + ''.join(f"{digest} {length}\n" for digest, length in self.entries).encode()
+
+    def offsets(self):
+        offsets = []
+        offset = 0
+        for _, length in self.entries:
+            offsets.append(offset)
+            offset += length
+        return offsets
+
+    def missing(self, store):
+        """Return the [first, last) index ranges of chunks the store lacks, each digest only once."""
+        ranges = []
+        wanted = set()
+        for index, (digest, _) in enumerate(self.entries):
+            if digest in wanted or store.has(digest):
+                continue
+            wanted.add(digest)
+            if ranges and ranges[-1][1] == index:
+                ranges[-1] = (ranges[-1][0], index + 1)
+            else:
+                ranges.append((index, index + 1))
+        return ranges
+
+    def save(self, path):
+        temp_path = f"{path}.part"
+        with open(temp_path, 'wb') as f:
+            f.write(self.encode())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.decode(f.read())
+
+
+class ChunkStore:
+    """Chunks kept once each under <folder>/.chunks/<first two hex digits>/<sha256>.
+
+    A chunk is kept while a saved recipe refers to it or an upload in
+    progress has it pinned. Recipe references are counted, read from the
+    recipes in the folder the first time they are needed, so dropping a
+    recipe only looks at the chunks it used.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.root = os.path.join(folder, STORE_DIR)
+        self.lock = threading.Lock()
+        self.refs = None  # Digest -> saved recipes using it, loaded on first use
+        self.pins = {}  # Digest -> uploads in progress that need it
+
+    def _load_refs(self):
+        if self.refs is not None:
+            return
+        self.refs = {}
+        for name in os.listdir(self.folder) if os.path.isdir(self.folder) else ():
+            if name.startswith('.') and name.endswith('.recipe'):
+                self._count(Recipe.load(os.path.join(self.folder, name)), 1)
+
+    def _count(self, recipe, step):
+        for digest in {digest for digest, _ in recipe.entries}:
+            count = self.refs.get(digest, 0) + step
+            if count:
+                self.refs[digest] = count
+            else:
+                self.refs.pop(digest, None)
+
+    def _remove_unused(self, digests):
+        for digest in digests:
+            if digest not in self.refs and digest not in self.pins:
+                try:
+                    os.remove(self.path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest, data):
+        """Store data under digest; returns False if it does not hash to digest."""
+        if hashlib.sha256(data).hexdigest() != digest:
+            return False
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return True
+
+    def get(self, digest):
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+    @contextmanager
+    def pinned(self, recipe):
+        """Keep every chunk of recipe for the with block, whether stored yet or not.
+
+        Chunks it stored that no saved recipe uses are removed afterwards,
+        e.g. when the upload failed.
+        """
+        digests = {digest for digest, _ in recipe.entries}
+        with self.lock:
+            for digest in digests:
+                self.pins[digest] = self.pins.get(digest, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self._load_refs()
+                for digest in digests:
+                    if self.pins[digest] == 1:
+                        del self.pins[digest]
+                    else:
+                        self.pins[digest] -= 1
+                self._remove_unused(digests)
+
+    def save_recipe(self, recipe, path):
+        """Save recipe at path in place of any recipe there; returns False if the store lacks some of its chunks."""
+        with self.lock:
+            if not all(self.has(digest) for digest, _ in recipe.entries):
+                return False
+            self._load_refs()
+            old = Recipe.load(path) if os.path.exists(path) else None
+            recipe.save(path)
+            self._count(recipe, 1)
+            if old:
+                self._count(old, -1)
+                self._remove_unused({digest for digest, _ in old.entries})
+            return True
+
+    def discard_recipe(self, path):
+        """Delete the recipe at path and the chunks only it used; returns False if there is none."""
+        with self.lock:
+            if not os.path.exists(path):
+                return False
+            self._load_refs()
+            recipe = Recipe.load(path)
+            os.remove(path)
+            self._count(recipe, -1)
+            self._remove_unused({digest for digest, _ in recipe.entries})
+            return True
+
+    def collect_garbage(self):
+        """Remove every chunk no recipe refers to and no upload has pinned, e.g. left by a crash.
+
+        Lists the whole store, so it is meant for startup rather than after every change.
+        """
+        with self.lock:
+            self.refs = None
+            self._load_refs()
+            if not os.path.isdir(self.root):
+                return
+            for prefix in os.listdir(self.root):
+                for name in os.listdir(os.path.join(self.root, prefix)):
+                    if name.endswith('.part'):
+                        continue
+                    self._remove_unused([name])
+
+
+class RecipeReader:
+    """Read-only file object over a recipe, so files rebuilt from the store stream like regular ones."""
+
+    def __init__(self, store, recipe):
+        self.store = store
+        self.recipe = recipe
+        self.offsets = recipe.offsets()
+        self.position = 0
+        self.cached = (None, b'')
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.recipe.size
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.recipe.size if size < 0 else min(self.position + size, self.recipe.size)
+        parts = []
+        while self.position < end:
+            index = bisect.bisect_right(self.offsets, self.position) - 1
+            if self.cached[0] != index:
+                self.cached = (index, self.store.get(self.recipe.entries[index][0]))
+            start = self.position - self.offsets[index]
+            part = self.cached[1][start:start + end - self.position]
+            parts.append(part)
+            self.position += len(part)
+        return b''.join(parts)
+
+    def close(self):
+        self.cached = (None, b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def recipe_path(filepath):
+    return os.path.join(os.path.dirname(filepath), f".{os.path.basename(filepath)}.recipe")
+
+
+def stored_size(filepath):
+    """Size of a stored file, whether it is a regular file or a recipe."""
+    if os.path.isfile(filepath):
+        return os.path.getsize(filepath)
+    return Recipe.load(recipe_path(filepath)).size
+
+
+def open_stored(filepath, store):
+    if os.path.isfile(filepath):
+        return open(filepath, 'rb')
+    return RecipeReader(store, Recipe.load(recipe_path(filepath)))
+
+
+def discard_recipe(filepath, store):
+    """Drop the recipe of filepath, if any, and the chunks only it used."""
+    return store.discard_recipe(recipe_path(filepath))
+
+
+def stored_files(folder):
+    """Return (name, size) for every regular file and recipe in folder, hiding other dot-files."""
+    files = []
+    for name in os.listdir(folder):
+        filepath = os.path.join(folder, name)
+        if not name.startswith('.'):
+            if os.path.isfile(filepath):
+                files.append((name, os.path.getsize(filepath)))
+        elif name.endswith('.recipe') and os.path.isfile(filepath):
+            files.append((name[1:-len('.recipe')], Recipe.load(filepath).size))
+    return files
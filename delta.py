@@ -0,0 +1,211 @@
+import zlib
+import struct
+import hashlib
+
+# rsync-style delta transfer. The receiver holding the old copy sends a
+# signature per block: an Adler-32 that can be rolled one byte at a time
+# and a short BLAKE2b to confirm a match. The sender slides a block-sized
+# window over its new copy and turns it into operations that either copy
+# old blocks or carry new bytes, each tagged with its offset in the new
+# file so they can be applied in any order.
+BLOCK_SIZE = 64 * 1024
+MAX_BLOCKS = 1 << 16  # Larger files get bigger blocks to keep signatures small
+MAX_LITERAL = 1024 * 1024  # New bytes per operation, so one fits a chunk frame
+MAX_COPY = 64 * 1024 * 1024  # Bytes per copy operation, so progress keeps moving through unchanged stretches
+MIN_SIZE = 1024 * 1024  # Smaller files fit one chunk frame and are sent whole instead
+MAX_NEW_FRACTION = 0.5  # Past this share of new bytes the sender gives up and sends the file whole
+READ_SIZE = 4 * 1024 * 1024
+ADLER_MOD = 65521
+
+SIGNATURE = struct.Struct('!I16s')  # Adler-32, BLAKE2b-128
+OP_HEADER = struct.Struct('!cQ')  # b'C' (copy) or b'D' (data), offset in the new file
+COPY = struct.Struct('!QI')  # First old block, block count
+
+
+def block_size_for(filesize):
+    block_size = BLOCK_SIZE
+    while filesize > block_size * MAX_BLOCKS:
+        block_size *= 2
+    return block_size
+
+
+def strong_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def signatures(f, block_size):
+    """Return the packed signatures of every block of f, the last one possibly short."""
+    parts = []
+    for block in iter(lambda: f.read(block_size), b''):
+        parts.append(SIGNATURE.pack(zlib.adler32(block), strong_digest(block)))
+    return b''.join(parts)
+
+
+class Signatures:
+    """Signatures sent by the receiver, looked up by weak checksum."""
+
+    def __init__(self, data, block_size, filesize):
+        self.block_size = block_size
+        self.filesize = filesize
+        self.by_weak = {}
+        self.low_halves = bytearray(1 << 16)  # 1 at the low 16 bits of every block's weak checksum
+        self.count = len(data) // SIGNATURE.size
+        for index in range(self.count):
+            weak, strong = SIGNATURE.unpack_from(data, index * SIGNATURE.size)
+            self.by_weak.setdefault(weak, []).append((index, strong))
+            self.low_halves[weak & 0xFFFF] = 1
+        self.tail_length = filesize - (self.count - 1) * block_size if self.count else 0
+
+    def match(self, weak, window):
+        candidates = self.by_weak.get(weak)
+        if not candidates:
+            return None
+        strong = strong_digest(window)
+        for index, candidate in candidates:
+            if candidate == strong:
+                return index
+        return None
+
+    def block_length(self, index):
+        return self.tail_length if index == self.count - 1 else self.block_size
+
+
+def scan(buf, start, stop, weak, signatures):
+    """Roll the weak checksum of the block at buf[start] forward to the first block whose checksum is known.
+
+    Returns (position, its weak checksum), or stop and its checksum if no
+    block before it has one. buf must hold the block at stop. This is the
+    inner loop of delta_ops over new data, kept to a few local operations
+    per byte with the low half of the checksum tested first.
+    """
+    block_size = signatures.block_size
+    by_weak = signatures.by_weak
+    low_halves = signatures.low_halves
+    factor = block_size % ADLER_MOD
+    a = weak & 0xFFFF
+    b = weak >> 16
+    position = start
+    for out_byte, in_byte in zip(buf[start:stop], buf[start + block_size:stop + block_size]):
+        a = (a - out_byte + in_byte) % ADLER_MOD
+        b = (b - factor * out_byte + a - 1) % ADLER_MOD
+        position += 1
+        if low_halves[a] and (b << 16 | a) in by_weak:
+            break
+    return position, b << 16 | a
+
+
+def delta_ops(f, signatures, file_hash=None):
+    """Yield (operation payload, bytes of the new file it covers) turning the old copy into f.
+
+    Runs of matching blocks become one copy operation. file_hash, if given,
+    is fed all of f as it is read.
+    """
+    block_size = signatures.block_size
+    buf = bytearray()
+    base = 0  # Offset in f of buf[0]
+    pos = 0
+    literal_start = 0
+    eof = False
+    weak = None
+    copy = None  # Pending [target offset, first block, count, covered]
+
+    def fill(end):
+        nonlocal eof
+        while not eof and base + len(buf) < end:
+            data = f.read(READ_SIZE)
+            eof = not data
+            buf.extend(data)
+            if file_hash is not None:
+                file_hash.update(data)
+
+    def literal(end):
+        return OP_HEADER.pack(b'D', literal_start) + bytes(buf[literal_start - base:end - base]), end - literal_start
+
+    def copy_op():
+        return OP_HEADER.pack(b'C', copy[0]) + COPY.pack(copy[1], copy[2]), copy[3]
+
+    def matched(index):
+        nonlocal copy
+        length = signatures.block_length(index)
+        if copy and copy[0] + copy[3] == pos and copy[1] + copy[2] == index and copy[3] < MAX_COPY:
+            copy[2] += 1
+            copy[3] += length
+            return None
+        previous = copy_op() if copy else None
+        copy = [pos, index, 1, length]
+        return previous
+
+    while True:
+        fill(pos + block_size)
+        end = base + len(buf)
+        if pos + block_size > end:
+            break
+        i = pos - base
+        if weak is None:
+            weak = zlib.adler32(buf[i:i + block_size])
+        index = signatures.match(weak, buf[i:i + block_size]) if weak in signatures.by_weak else None
+        if index is not None:
+            if literal_start < pos:
+                yield literal(pos)
+            op = matched(index)
+            if op:
+                yield op
+            pos += block_size
+            literal_start = pos
+            weak = None
+            del buf[:pos - base]
+            base = pos
+            continue
+
+        fill(pos + block_size + 1)
+        end = base + len(buf)
+        if pos + block_size >= end:
+            break
+        # Skip ahead to the next offset that may start a known block.
+        stop = min(end - block_size, literal_start + MAX_LITERAL)
+        i, weak = scan(buf, i, stop - base, weak, signatures)
+        pos = base + i
+        if pos - literal_start >= MAX_LITERAL:
+            yield literal(pos)
+            literal_start = pos
+            del buf[:pos - base]
+            base = pos
+
+    end = base + len(buf)
+    tail = signatures.count - 1
+    if end > pos and end - pos == signatures.tail_length and signatures.match(zlib.adler32(buf[pos - base:]), buf[pos - base:]) == tail:
+        if literal_start < pos:
+            yield literal(pos)
+        op = matched(tail)
+        if op:
+            yield op
+        literal_start = pos = end
+    while literal_start < end:
+        op = literal(min(end, literal_start + MAX_LITERAL))
+        yield op
+        literal_start += op[1]
+    if copy:
+        yield copy_op()
+
+
+def apply_op(payload, source, target, block_size):
+    """Apply one operation from delta_ops, reading old blocks from source and writing target."""
+    kind, offset = OP_HEADER.unpack_from(payload)
+    target.seek(offset)
+    if kind == b'D':
+        target.write(payload[OP_HEADER.size:])
+    elif kind == b'C':
+        first_block, count = COPY.unpack_from(payload, OP_HEADER.size)
+        source.seek(first_block * block_size)
+        for _ in range(count):
+            target.write(source.read(block_size))
+    else:
+        raise ValueError(f"unknown delta operation {kind!r}")
+
+
+def file_digest(f):
+    f.seek(0)
+    file_hash = hashlib.sha256()
+    for data in iter(lambda: f.read(READ_SIZE), b''):
+        file_hash.update(data)
+    return file_hash.hexdigest()
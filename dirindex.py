@@ -0,0 +1,172 @@
+import os
+import stat as stat_module
+import bisect
+import threading
+from collections import namedtuple
+import batch
+import dedup
+
+PAGE_SIZE = 1000  # Entries per 'l' reply unless the client asks for fewer
+MAX_PAGE_SIZE = 10000
+
+IndexEntry = namedtuple('IndexEntry', 'size mtime digest')  # mtime in ns, digest a SHA-256 hex or None
+
+
+class DirectoryIndex:
+    """In-memory listing of a server folder: name -> IndexEntry, names kept sorted.
+
+    Files in subfolders are listed as "dir/name". The server updates single
+    entries as files are stored and deleted, and records the directory's new
+    mtime then, so its own temp files and sidecars never cause a rescan.
+    Any other change to the folder tree changes the mtime of some directory
+    in it, and the next query then rescans it, reusing the entries of files
+    whose size and mtime did not change; one landing in the same directory
+    just before a server update goes unseen until the next. Files modified
+    in place do not touch any directory mtime; stat() picks those up since
+    it always looks at the file itself.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = {}
+        self.names = []
+        self.dir_mtimes = None  # Relative directory -> mtime_ns at the last scan
+        self.lock = threading.Lock()
+
+    def _dir_mtime(self, relpath):
+        try:
+            return os.stat(os.path.join(self.folder, relpath)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _refresh(self):
+        if self.dir_mtimes is None or any(self._dir_mtime(relpath) != mtime for relpath, mtime in self.dir_mtimes.items()):
+            self._scan()
+
+    def invalidate(self):
+        """Make the next query rescan, e.g. after many files were stored at once."""
+        with self.lock:
+            self.dir_mtimes = None
+
+    def _scan(self):
+        entries = {}
+        dir_mtimes = {'': self._dir_mtime('')}
+        pending = [''] if dir_mtimes[''] is not None else []
+        while pending:
+            relpath = pending.pop()
+            with os.scandir(os.path.join(self.folder, relpath)) as it:
+                for dir_entry in it:
+                    name = dir_entry.name
+                    if dir_entry.is_dir():
+                        # Dot-directories such as the chunk store are internal.
+                        if not name.startswith('.'):
+                            child = f"{relpath}/{name}" if relpath else name
+                            dir_mtimes[child] = dir_entry.stat().st_mtime_ns
+                            pending.append(child)
+                        continue
+                    if name.startswith('.'):
+                        # Recipes stand for deduplicated files, other dot-files are internal.
+                        if not name.endswith('.recipe'):
+                            continue
+                        name = name[1:-len('.recipe')]
+                    if not dir_entry.is_file():
+                        continue
+                    name = f"{relpath}/{name}" if relpath else name
+                    entries[name] = self._entry(name, dir_entry.path, dir_entry.stat())
+        self.entries = entries
+        self.names = sorted(entries)
+        self.dir_mtimes = dir_mtimes
+
+    def _entry(self, name, path, stat):
+        old = self.entries.get(name)
+        if old and old.mtime == stat.st_mtime_ns and (path.endswith('.recipe') or old.size == stat.st_size):
+            return old
+        size = dedup.Recipe.load(path).size if path.endswith('.recipe') else stat.st_size
+        return IndexEntry(size, stat.st_mtime_ns, None)
+
+    def _stat_one(self, name):
+        """Look at one file on disk and bring its entry up to date; returns it or None.
+
+        Names _scan would not list, such as dot-files, directories or paths
+        outside the folder, are never added.
+        """
+        if '\\' in name:
+            return None  # Listed names always use '/'
+        try:
+            filepath = batch.safe_path(self.folder, name)
+        except ValueError:
+            return None
+        for path in (filepath, dedup.recipe_path(filepath)):
+            try:
+                stat = os.stat(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if not stat_module.S_ISREG(stat.st_mode):
+                continue
+            entry = self._entry(name, path, stat)
+            if name not in self.entries:
+                bisect.insort(self.names, name)
+            self.entries[name] = entry
+            return entry
+        if self.entries.pop(name, None) is not None:
+            self.names.remove(name)
+        return None
+
+    def _record_directory(self, directory):
+        if self.dir_mtimes is None:
+            return  # The next query scans everything anyway
+        if directory in self.dir_mtimes:
+            self.dir_mtimes[directory] = self._dir_mtime(directory)
+        else:
+            self.dir_mtimes = None  # A new subfolder, found by a rescan
+
+    def update(self, name, digest=None):
+        """Record that name was stored or deleted by the server, with its SHA-256 if known."""
+        with self.lock:
+            entry = self._stat_one(name)
+            if entry and digest:
+                self.entries[name] = entry._replace(digest=digest)
+            self._record_directory(os.path.dirname(name))
+
+    def wrote_internal(self, path):
+        """Record that the server wrote a dot-file such as a sidecar at path, so it causes no rescan."""
+        directory = os.path.relpath(os.path.dirname(path), self.folder)
+        with self.lock:
+            self._record_directory('' if directory == '.' else directory.replace(os.sep, '/'))
+
+    def stat(self, name):
+        with self.lock:
+            return self._stat_one(name)
+
+    def set_digest(self, name, entry, digest):
+        """Cache the digest of name computed for entry, unless the file changed meanwhile."""
+        with self.lock:
+            if self.entries.get(name) == entry:
+                self.entries[name] = entry._replace(digest=digest)
+
+    def files(self):
+        """Return (name, IndexEntry) for every file, sorted by name."""
+        with self.lock:
+            self._refresh()
+            return [(name, self.entries[name]) for name in self.names]
+
+    def page(self, prefix='', after='', limit=PAGE_SIZE):
+        """Return up to limit (name, IndexEntry) pairs whose names start with prefix and sort after `after`.
+
+        The second value is the name to pass as `after` for the next page,
+        or None when there are no more.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self.lock:
+            self._refresh()
+            start = bisect.bisect_left(self.names, prefix)
+            if after:
+                start = max(start, bisect.bisect_right(self.names, after))
+            page = []
+            for name in self.names[start:start + limit + 1]:
+                if not name.startswith(prefix):
+                    break
+                page.append((name, self.entries[name]))
+        if len(page) > limit:
+            return page[:limit], page[limit - 1][0]
+        return page, None
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+PROGRESS_INTERVAL = 2.0  # Seconds between progress reports for one transfer
+PROGRESS_RATE = 30  # Most progress callbacks per second a client front-end gets
+
+
+class LoggingSink:
+    """Event sink for headless servers: messages go to the logging module.
+
+    Any object with log_message() and update_client_count() can be handed to
+    Server or AsyncServer as its ui, ServerUI being the Tk one.
+    """
+
+    def log_message(self, message):
+        logging.info(message)
+
+    def update_client_count(self, count):
+        logging.debug(f"Connected clients: {count}")
+
+
+class TransferProgress:
+    """Counts the chunks of one transfer and reports to the sink at most once per interval.
+
+    chunk() only bumps counters on the data path; the sink sees a summary
+    line every few seconds and once when the transfer is done.
+    """
+
+    def __init__(self, sink, description, interval=PROGRESS_INTERVAL):
+        self.sink = sink
+        self.description = description
+        self.interval = interval
+        self.chunks = 0
+        self.bytes = 0
+        self.started = self.last_report = time.monotonic()
+
+    def chunk(self, size):
+        self.chunks += 1
+        self.bytes += size
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.sink.log_message(f"{self.description}: {self.chunks} chunks, {self.bytes / 1048576:.1f} MB so far")
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return f"{self.chunks} chunks, {self.bytes / 1048576:.1f} MB in {elapsed:.2f}s ({self.bytes / 1048576 / elapsed:.1f} MB/s)"
+
+
+class ProgressThrottle:
+    """Takes the place of the share_queue Client transfers report to, calling back instead of being polled.
+
+    Transfers call put(size) from their own threads for every chunk;
+    on_progress(done, total) runs at most rate times a second, and always
+    once done reaches the total, and finish(ok) calls on_done(ok) once
+    when the transfer returns. Without a total the
+    first put() is taken as one, as downloads report their size before any
+    chunk. Both callbacks run on the transfer thread, so a Tk front-end
+    hands them to its loop with after().
+    """
+
+    def __init__(self, on_progress, on_done, total=None, rate=PROGRESS_RATE):
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.total = total
+        self.interval = 1 / rate
+        self.done = 0
+        self.last_report = 0.0
+        self.finished = False
+        self.lock = threading.Lock()  # Parallel transfers report from several threads
+
+    def put(self, size):
+        with self.lock:
+            if self.total is None:
+                self.total = size
+                return
+            self.done += size
+            now = time.monotonic()
+            if now - self.last_report < self.interval and self.done < self.total:
+                return
+            self.last_report = now
+            done, total = self.done, self.total
+        self.on_progress(done, total)
+
+    def finish(self, ok):
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        self.on_done(ok)
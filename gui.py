@@ -1,15 +1,14 @@
 import os
-import sys
 from customtkinter import *
 import client
 import socket
 from PIL import Image, ImageGrab, ImageEnhance
 from tkinter import filedialog, messagebox
-import queue
 import threading
-import time
+import events
 SERVER_IP = socket.gethostbyname(socket.gethostname())
 SERVER_PORT = 5000
+STALL_MS = 15000  # A transfer that reports no progress for this long is shown as failed
 
 def take_screenshot():
     x0 = app.winfo_rootx()
@@ -22,82 +21,102 @@ def take_screenshot():
     output = enhancer.enhance(0.5) 
     output.save("client/dark.png")
 
-def error_hand(client1, thread):
+def error_hand(client1):
     fai_img = CTkImage(dark_image=Image.open('client/fail.png'), light_image=Image.open('client/fail.png'), size=(425.59,283))
     picture_label.configure(image=fai_img)
     text_per.configure(text ="")
     text_per.update()
     app.after(1000, lambda: refresh(client1, file_display_frame))
 
-def moved(share_queue,  client1, size_downloaded, filesize, thread, timer):
-    try:
-        lent=share_queue.get(block = False)
-    except queue.Empty:
-        lent = 0
-    else:
-        size_downloaded += lent
-
-        percentage = size_downloaded / filesize * 100
-        per = str(int(percentage))
-        text_per.configure(text = per + "%")
-        text_per.update()
-
+def track(client1, total=None):
+    """Return a ProgressThrottle that drives the progress bar and shows the outcome.
+
+    Its callbacks come from the transfer thread and are handed to the Tk
+    loop with after(), so nothing polls while a transfer runs.
+    """
+    # The watchdog is armed by progress only: hashing before the first chunk
+    # and the server's checks after the last one are not stalls.
+    state = {'over': False, 'watchdog': None}
+
+    def stalled():
+        state['over'] = True
+        error_hand(client1)
+
+    def disarm():
+        if state['watchdog']:
+            app.after_cancel(state['watchdog'])
+            state['watchdog'] = None
+
+    def show(done, total):
+        if state['over']:
+            return
+        disarm()
+        if total and done < total:
+            state['watchdog'] = app.after(STALL_MS, stalled)
+        percentage = done / total * 100 if total else 100
+        text_per.configure(text = str(int(percentage)) + "%")
         progress.set(float(percentage) / 100)
 
-    if(size_downloaded < filesize):
-        if lent != 0:
-            timer.cancel()
-            timer = threading.Timer(5, lambda: error_hand(client1, thread))
-            timer.start()
-        if share_queue.empty():
-            app.after(5, lambda: moved(share_queue, client1, size_downloaded, filesize, thread, timer))
-        else :
-            app.after(1, lambda: moved(share_queue, client1, size_downloaded, filesize, thread, timer))
-    elif(size_downloaded >= filesize):
+    def finished(ok):
+        if state['over']:
+            return
+        state['over'] = True
+        disarm()
+        if not ok:
+            error_hand(client1)
+            return
         done_img = CTkImage(dark_image=Image.open('client/done.png'), light_image=Image.open('client/done.png'), size=(425.59,283))
         picture_label.configure(image=done_img)
         text_per.configure(text ="100%", bg_color="#F99F3E", text_color="#0A1721")
-        text_per.update()
-        timer.cancel()
-
         progress.set(1)
         app.after(1500, lambda: refresh(client1, file_display_frame))
 
+    return events.ProgressThrottle(lambda done, total: app.after(0, lambda: show(done, total)),
+                                   lambda ok: app.after(0, lambda: finished(ok)), total)
+
+def run_transfer(throttle, target, *args, **kwargs):
+    """Thread body: run a Client transfer reporting to throttle, then report how it ended."""
+    ok = False
+    try:
+        ok = target(*args, throttle, **kwargs)
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        throttle.finish(ok)
+
 
 def upload(client1):
     filepath = filedialog.askopenfilename()
     if filepath:
         filename = os.path.basename(filepath)
-        existing_files = []
+        overwrite = False
         try:
-            existing_files = client1.list()
+            overwrite = client1.stat(filename) is not None
         except Exception as e:
             print(f"Error: {e}")
             refresh(client1, file_display_frame)
-        
-        if any(f[0] == filename for f in existing_files):
+
+        if overwrite:
             result = messagebox.askyesno("File Exists", f"The file '{filename}' already exists on the server. Do you want to overwrite it?")
             if not result:
                 return  # Cancel upload
-        time.sleep(0.2)
+        app.update()  # Let the dialog close before the screenshot
         take_screenshot()
         picture_frame.place(x=161.75, y=86.48)
         img_grey = CTkImage(dark_image=Image.open('client/dark.png'), light_image=Image.open('client/dark.png'), size=(750, 500))
         grey.configure(image=img_grey)
         grey.place(x=0, y=0)
-        share_queue =queue.Queue()
-        size_downloaded = 0
-        filesize = os.path.getsize(filepath)
-        upload_thread = threading.Thread(target=client1.upload_file, args=(filepath, True, share_queue))
+        throttle = track(client1, os.path.getsize(filepath))
+        # An overwrite only sends the blocks that differ from the server's copy, or nothing if it is the same.
+        upload_thread = threading.Thread(target=run_transfer, args=(throttle, client1.upload_file, filepath, True),
+                                         kwargs={'delta_sync': overwrite, 'skip_identical': overwrite})
         upload_thread.daemon = True
         try:
             upload_thread.start()
         except Exception as e:
             print(f"Error: {e}")
             refresh(client1, file_display_frame)
-        timer = threading.Timer(15, lambda: error_hand(client1, upload_thread))
-        app.after(10, lambda: moved(share_queue, client1, size_downloaded, filesize, upload_thread, timer))
-        
+
 
 
 def get_file_icon(file_name):
@@ -155,9 +174,11 @@ def refresh(client1, frame):
     try:
         files = client1.list()
     except Exception as e:
+        # The pool already retried on a new connection, so the server is gone.
         print(f"Error: {e}")
         client1.close()
         show_initial_screen(app, True)
+        return
 
 
     if not files:
@@ -250,28 +271,29 @@ def refresh(client1, frame):
 def on_select(action, file_name, client1):
     if action == "DOWNLOAD":
         try:
-            test = client1.list()
+            client1.stat(file_name)
         except Exception as e:
             print(f"Error: {e}")
             refresh(client1, file_display_frame)
         des = filedialog.askdirectory()
         if des:
             download_path = os.path.join(des, file_name)
-            if os.path.exists(download_path):
+            overwrite = os.path.exists(download_path)
+            if overwrite:
                 result = messagebox.askyesno("File Exists", f"The file '{file_name}' already exists in the selected directory. Do you want to overwrite it?")
                 if not result:
                     return  # Cancel download
-            time.sleep(0.2)
+            app.update()  # Let the dialog close before the screenshot
             take_screenshot()
             picture_frame.place(x=161.75, y=86.48)
             img_grey = CTkImage(dark_image=Image.open('client/dark.png'), light_image=Image.open('client/dark.png'), size=(750, 500))
             grey.configure(image=img_grey)
             grey.place(x=0, y=0)
             picture_frame.place(x=161.75, y=86.48)
-            share_queue = queue.Queue()
-            size_downloaded = 0
-            
-            download_thread = threading.Thread(target=client1.download_file, args=(file_name, des, True, share_queue))
+            # The download reports the file size first, see events.ProgressThrottle.
+            throttle = track(client1)
+            download_thread = threading.Thread(target=run_transfer, args=(throttle, client1.download_file, file_name, des, True),
+                                               kwargs={'skip_identical': overwrite})
             download_thread.daemon = True
             try:
                 download_thread.start()
@@ -279,11 +301,6 @@ def on_select(action, file_name, client1):
                 print(f"Error: {e}")
                 refresh(client1, file_display_frame)
                 return
-            while share_queue.empty():
-                time.sleep(0.1)
-            filesize = share_queue.get(block=False)
-            timer = threading.Timer(15, lambda: error_hand(client1, download_thread))
-            app.after(10, lambda: moved(share_queue, client1, size_downloaded, filesize, download_thread, timer))
     elif action == "DELETE":
         if messagebox.askokcancel("Confirm Delete", f"Are you sure you want to delete the file '{file_name}'?"):
             try:
@@ -313,7 +330,8 @@ def confirm():
             global SERVER_IP, SERVER_PORT
             SERVER_IP = ip
             SERVER_PORT = int(port)
-            client1 = client.Client(SERVER_IP, SERVER_PORT)
+            # A pool lets the file list refresh while a transfer runs, and reconnects on its own.
+            client1 = client.ClientPool(SERVER_IP, SERVER_PORT)
             client1.connect()
             print("Connected to the server")
             show_main_app(client1)
@@ -0,0 +1,171 @@
+import os
+import mmap
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Read-only memory maps of stored files, shared by every connection that
+# downloads them. Chunks are handed out as memoryview slices of the map, so
+# a file sent to many clients at once is read through the page cache once
+# instead of being copied onto the heap per connection. The server only
+# ever replaces stored files, never rewrites them in place, so a mapping
+# stays readable until it is released. Another process truncating a mapped
+# file would make reads past its new end fault with SIGBUS and kill the
+# server, so only files the server wrote itself are mapped, and reads check
+# the file's size first; anything else is read normally. Windows cannot
+# replace or delete a file while it is mapped, so mapping is off there.
+MAP_CACHE_SIZE = 32  # Idle mappings kept open
+ENABLED = os.name != 'nt'
+
+
+class MappedFile:
+    """One mapping of a file as it was when mapped; stale once the file was replaced."""
+
+    def __init__(self, path, key, mm):
+        self.path = path
+        self.key = key  # (st_ino, st_size, st_mtime_ns) the mapping was made from
+        self.mmap = mm
+        self.view = memoryview(mm)
+        self.size = len(mm)
+        self.refs = 0
+        self.stale = False
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Slices of it are still referenced somewhere; the map is
+            # unmapped when the last of them goes away.
+            pass
+
+
+class MappedReader:
+    """File-like reader over a MappedFile whose read() returns memoryview slices instead of copies."""
+
+    def __init__(self, mapped):
+        self.mapped = mapped
+        self.name = mapped.path
+        self.position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.mapped.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.mapped.size if size is None or size < 0 else min(self.position + size, self.mapped.size)
+        if end > self.position and self.mapped.mmap.size() < end:
+            raise OSError(f"{self.name} was truncated while mapped")
+        data = self.mapped.view[self.position:end]
+        self.position = max(self.position, end)
+        return data
+
+
+class MapCache:
+    """Refcounted mappings keyed by path, with the idle ones evicted least recently used first.
+
+    A mapping in use is never unmapped under its readers: dropping it from
+    the cache only marks it stale, and it is closed when released.
+    """
+
+    def __init__(self, capacity=MAP_CACHE_SIZE, enabled=ENABLED):
+        self.capacity = capacity
+        self.enabled = enabled
+        self.maps = OrderedDict()  # Path -> MappedFile, least recently used first
+        self.owned = {}  # Path -> (st_ino, st_size, st_mtime_ns) of files the server wrote itself
+        self.lock = threading.Lock()
+
+    def adopt(self, path):
+        """Allow path to be mapped as it is now; call once the server has put a file it wrote there."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.owned[path] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def acquire(self, path):
+        """Return the MappedFile of path with a reference taken, or None if it cannot be mapped."""
+        if not self.enabled:
+            return None
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if not stat.st_size:
+            return None  # Empty files cannot be mapped
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if self.owned.get(path) != key:
+                return None  # Not written by the server, or changed since
+            mapped = self.maps.get(path)
+            if mapped is not None and mapped.key == key:
+                self.maps.move_to_end(path)
+                mapped.refs += 1
+                return mapped
+            if mapped is not None:
+                self._drop(path)
+        # Map outside the lock; another thread may map the same file meanwhile.
+        with open(path, 'rb') as f:
+            mapped = MappedFile(path, key, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        with self.lock:
+            current = self.maps.get(path)
+            if current is not None and current.key == key:
+                mapped.close()
+                mapped = current
+                self.maps.move_to_end(path)
+            else:
+                if current is not None:
+                    self._drop(path)
+                self.maps[path] = mapped
+            mapped.refs += 1
+            self._evict()
+            return mapped
+
+    def release(self, mapped):
+        with self.lock:
+            mapped.refs -= 1
+            if not mapped.refs and mapped.stale:
+                mapped.close()
+            self._evict()
+
+    def invalidate(self, path):
+        """Forget the mapping of path; call before the file is replaced or deleted."""
+        with self.lock:
+            self.owned.pop(path, None)
+            if path in self.maps:
+                self._drop(path)
+
+    def _drop(self, path):
+        mapped = self.maps.pop(path)
+        mapped.stale = True
+        if not mapped.refs:
+            mapped.close()
+
+    def _evict(self):
+        if len(self.maps) <= self.capacity:
+            return
+        for path in [path for path, mapped in self.maps.items() if not mapped.refs]:
+            self._drop(path)
+            if len(self.maps) <= self.capacity:
+                return
+
+    @contextmanager
+    def reader(self, path, opener=lambda path: open(path, 'rb')):
+        """Yield a MappedReader over path, or the file opener(path) returns if it cannot be mapped."""
+        mapped = self.acquire(path)
+        if mapped is None:
+            with opener(path) as f:
+                yield f
+            return
+        try:
+            yield MappedReader(mapped)
+        finally:
+            self.release(mapped)
@@ -0,0 +1,707 @@
+import os
+import time
+import socket
+import zlib
+import struct
+import hashlib
+import logging
+import itertools
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+WINDOW_SIZE = 8  # Chunks that may be in flight before the sender waits for an ACK
+MAX_RETRIES = 3
+SMALL_WRITE = 64 * 1024  # Frames up to this size go out in a single send
+
+# Version 1 is the original text chunk frame "<hex sha256>::<num>::<payload>"
+# with plain "ACK"/"NAK" replies. Version 2 frames start with FRAME_HEADER.
+# Connections start at version 1 and move up only through the 'v' action,
+# so clients that never send it keep working unchanged.
+PROTOCOL_VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+HELLO_TIMEOUT = 5  # Seconds to wait for a 'v' reply before assuming a version 1 server
+
+FRAME_MAGIC = 0xC5  # Cannot start a version 1 frame, whose first byte is a hex digit
+# magic, message type, flags, digest length, transfer id, chunk index, payload length;
+# the digest and then the payload follow the header.
+FRAME_HEADER = struct.Struct('!BBBBIQI')
+FRAME_LENGTH = struct.Struct('!I')
+
+MSG_DATA = 1
+MSG_END = 2  # End of a transfer; the chunk index holds the number of data chunks
+MSG_ACK = 3
+MSG_NAK = 4
+MSG_ABORT = 5  # The receiver gave up on the transfer and closes the connection
+
+FLAG_COMPRESSED = 0x01  # Payload is compressed with the session's codec; the digest is of the original data
+
+ChunkFrame = namedtuple('ChunkFrame', 'msg_type transfer_id chunk_num payload digest valid')
+
+
+class Checksum32:
+    """hashlib-style wrapper around a 32-bit checksum such as zlib.crc32."""
+
+    def __init__(self, func, data=b''):
+        self.func = func
+        self.value = func(data)
+
+    def update(self, data):
+        self.value = self.func(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, 'big')
+
+
+class KnownDigest:
+    """Stands in for a hash object when the whole-file digest is already stored."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def update(self, data):
+        pass
+
+    def digest(self):
+        return self.value
+
+
+# Digest algorithms a session can negotiate for its chunks and whole files,
+# each a factory taking the initial data. The checksums only catch accidental
+# corruption; use blake2b or sha256 where the link is not trusted.
+DIGESTS = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda data=b'': hashlib.blake2b(data, digest_size=32),
+    'crc32': lambda data=b'': Checksum32(zlib.crc32, data),
+    'adler32': lambda data=b'': Checksum32(zlib.adler32, data),
+}
+if crc32c is not None:
+    DIGESTS['crc32c'] = lambda data=b'': Checksum32(crc32c.crc32c, data)
+if xxhash is not None:
+    DIGESTS['xxh3'] = xxhash.xxh3_64
+DEFAULT_DIGEST = 'sha256'  # Version 1 frames always carry SHA-256
+
+# Chunk compression codecs a session can negotiate, as (compress, decompress).
+# Fresh zstd contexts are made per call because they are not thread-safe.
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+if zstandard is not None:
+    CODECS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+
+# Extensions whose contents are already compressed and are always sent raw
+COMPRESSED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.pdf', '.mp3', '.mp4', '.zip', '.rar',
+                         '.gz', '.bz2', '.xz', '.zst', '.7z'}
+COMPRESS_WORKERS = min(4, os.cpu_count() or 1)
+compress_pool = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS, thread_name_prefix='compress')
+compress_waiting = 0  # Chunks pack_ahead submitted to compress_pool that no worker has started on yet
+_compress_lock = threading.Lock()
+
+
+def send_data(sock, data):
+    # Sockets run with TCP_NODELAY (see no_delay), so a small frame written
+    # in two pieces would cost two packets; copying it is cheaper.
+    if len(data) <= SMALL_WRITE:
+        sock.sendall(FRAME_LENGTH.pack(len(data)) + data)
+    else:
+        sock.sendall(FRAME_LENGTH.pack(len(data)))
+        sock.sendall(data)
+
+
+def no_delay(sock):
+    """Send every write at once: request/reply actions and ACKs must not wait on Nagle's algorithm."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def calculate_checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def new_digest(algorithm, data=b''):
+    return DIGESTS[algorithm](data)
+
+
+def chunk_digest(data, algorithm=DEFAULT_DIGEST):
+    return DIGESTS[algorithm](data).digest()
+
+
+def negotiate_version(requested):
+    """Pick the highest version both sides support, given the peer's highest."""
+    return max(v for v in SUPPORTED_VERSIONS if v <= max(requested, 1))
+
+
+class Channel:
+    """A connected socket with a reusable receive buffer and its negotiated protocol version.
+
+    Frames are read with recv_into into one bytearray that only grows, and
+    receive_frame() hands them out as memoryviews into it, so receiving a
+    chunk allocates nothing. A frame stays valid until the next call.
+    digest is the algorithm of the per-chunk digests and file_digest the one
+    of the whole-file digest sent in END frames, None when not in use.
+    codec is the compression codec chunks may use, None for none.
+    """
+
+    def __init__(self, sock, version=1, buffer_size=FRAME_HEADER.size + 64 + 1024 * 1024):
+        self.sock = sock
+        self.version = version
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.length_view = memoryview(bytearray(FRAME_LENGTH.size))
+        self.transfer_ids = itertools.count(1)
+        self.digest = DEFAULT_DIGEST
+        self.file_digest = None
+        self.codec = None
+
+    def send_data(self, data):
+        send_data(self.sock, data)
+
+    def recv_exactly(self, view):
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if n == 0:
+                return False
+            received += n
+        return True
+
+    def receive_frame(self):
+        if not self.recv_exactly(self.length_view):
+            return None
+        data_len = FRAME_LENGTH.unpack(self.length_view)[0]
+        if data_len > len(self.buffer):
+            self.buffer = bytearray(data_len)
+            self.view = memoryview(self.buffer)
+        frame = self.view[:data_len]
+        if not self.recv_exactly(frame):
+            return None
+        return frame
+
+    def receive_data(self):
+        frame = self.receive_frame()
+        return None if frame is None else bytes(frame)
+
+    def request_version(self, version=PROTOCOL_VERSION, digest=DEFAULT_DIGEST, file_digest=None, codec=None):
+        """Client side of the 'v' action; falls back to version 1 if the server does not answer.
+
+        The request is "<version> <digest> <file_digest or -> <codec or ->"
+        and the reply has the same form with what the server accepted, or
+        just the version.
+        """
+        self.send_data(b'v')
+        self.send_data(f"{version} {digest} {file_digest or '-'} {codec or '-'}".encode())
+        self.sock.settimeout(HELLO_TIMEOUT)
+        try:
+            reply = self.receive_data()
+            fields = reply.decode().split() if reply else ['1']
+        except socket.timeout:
+            logging.warning("Server did not answer the version request, using protocol version 1.")
+            fields = ['1']
+        finally:
+            self.sock.settimeout(None)
+        self.version = int(fields[0])
+        self.digest = fields[1] if len(fields) > 1 else DEFAULT_DIGEST
+        self.file_digest = fields[2] if len(fields) > 2 and fields[2] != '-' else None
+        self.codec = fields[3] if len(fields) > 3 and fields[3] != '-' else None
+        return self.version
+
+    def answer_version(self, request):
+        """Server side of the 'v' action: settle on the version and digests, and return the reply."""
+        fields = request.split()
+        self.version = negotiate_version(int(fields[0]))
+        if self.version < 2:
+            return str(self.version).encode()
+        # Unknown algorithms fall back to SHA-256 per chunk and no whole-file digest.
+        self.digest = fields[1] if len(fields) > 1 and fields[1] in DIGESTS else DEFAULT_DIGEST
+        self.file_digest = fields[2] if len(fields) > 2 and fields[2] in DIGESTS else None
+        self.codec = fields[3] if len(fields) > 3 and fields[3] in CODECS else None
+        return f"{self.version} {self.digest} {self.file_digest or '-'} {self.codec or '-'}".encode()
+
+    def new_file_hash(self):
+        return new_digest(self.file_digest) if self.file_digest else None
+
+    def send_ack(self, frame, ok):
+        if self.version >= 2:
+            header = FRAME_HEADER.pack(FRAME_MAGIC, MSG_ACK if ok else MSG_NAK, 0, 0, frame.transfer_id, frame.chunk_num, 0)
+            self.send_data(header)
+        else:
+            self.send_data(b"ACK" if ok else b"NAK")
+
+    def abort(self):
+        """Give up on the current transfer and close the connection.
+
+        The other side may still have frames in flight, which must not be
+        read as requests or chunks, so the connection is shut down after
+        telling a version 2 peer with an abort frame.
+        """
+        try:
+            if self.version >= 2:
+                self.send_data(FRAME_HEADER.pack(FRAME_MAGIC, MSG_ABORT, 0, 0, 0, 0, 0))
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def receive_ack(self):
+        """Return (ok, chunk_num) for the next reply; chunk_num is None for version 1 replies.
+
+        Raises ConnectionError if the connection closes or the receiver aborts.
+        """
+        reply = self.receive_frame()
+        if reply is None:
+            raise ConnectionError("Connection closed while waiting for ACK")
+        if reply[0] == FRAME_MAGIC:
+            _, msg_type, _, _, _, chunk_num, _ = FRAME_HEADER.unpack_from(reply)
+            if msg_type == MSG_ABORT:
+                raise ConnectionError("Transfer aborted by the receiver")
+            return msg_type == MSG_ACK, chunk_num
+        return bytes(reply) == b"ACK", None
+
+
+def encode_chunk_header(version, msg_type, transfer_id, chunk_num, length, digest, flags=0):
+    """Build everything of a chunk frame that precedes the payload, length prefix included."""
+    if version >= 2:
+        header = FRAME_HEADER.pack(FRAME_MAGIC, msg_type, flags, len(digest), transfer_id, chunk_num, length) + digest
+    else:
+        header = digest.hex().encode() + b'::' + str(chunk_num).encode() + b'::'
+    return FRAME_LENGTH.pack(len(header) + length) + header
+
+
+def decode_chunk(frame, algorithm=DEFAULT_DIGEST, codec=None):
+    """Parse a chunk frame of either version into a ChunkFrame.
+
+    payload is a memoryview slice of frame, or the decompressed bytes of a
+    compressed one, and valid tells whether the digest matches it. The
+    digest of a version 2 END frame is the optional whole-file digest,
+    which only the caller can check. A version 1 frame with an empty
+    payload is reported as MSG_END. Raises ValueError on a malformed frame.
+    """
+    if frame and frame[0] == FRAME_MAGIC:
+        if len(frame) < FRAME_HEADER.size:
+            raise ValueError(f"chunk frame of {len(frame)} bytes is shorter than its header")
+        _, msg_type, flags, digest_len, transfer_id, chunk_num, length = FRAME_HEADER.unpack_from(frame)
+        digest = bytes(frame[FRAME_HEADER.size:FRAME_HEADER.size + digest_len])
+        payload = frame[FRAME_HEADER.size + digest_len:]
+        if len(payload) != length:
+            raise ValueError(f"chunk {chunk_num} payload is {len(payload)} bytes, header says {length}")
+        if flags & FLAG_COMPRESSED:
+            if codec is None:
+                raise ValueError(f"chunk {chunk_num} is compressed but no codec was negotiated")
+            try:
+                payload = CODECS[codec][1](payload)
+            except Exception as e:
+                raise ValueError(f"chunk {chunk_num} does not decompress: {e}")
+        valid = msg_type != MSG_DATA or chunk_digest(payload, algorithm) == digest
+        return ChunkFrame(msg_type, transfer_id, chunk_num, payload, digest, valid)
+
+    checksum, chunk_num, _ = bytes(frame[:96]).split(b'::', 2)
+    payload = frame[len(checksum) + len(chunk_num) + 4:]
+    digest = bytes.fromhex(checksum.decode())
+    return ChunkFrame(MSG_DATA if payload else MSG_END, 0, int(chunk_num.decode()), payload, digest, chunk_digest(payload) == digest)
+
+
+class FileRegion:
+    """A chunk that stays in its file, with a digest computed ahead of time.
+
+    send_chunk hands these to socket.sendfile, so the payload goes from the
+    page cache to the socket without being copied into Python objects.
+    """
+
+    __slots__ = ('f', 'offset', 'length', 'digest')
+
+    def __init__(self, f, offset, length, digest):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.digest = digest
+
+    def __len__(self):
+        return self.length
+
+
+class PackedChunk:
+    """A chunk prepared on the compression pool: its digest and the payload to send."""
+
+    __slots__ = ('data', 'payload', 'flags', 'digest')
+
+    def __init__(self, data, payload, flags, digest):
+        self.data = data
+        self.payload = payload
+        self.flags = flags
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.data)
+
+
+def pack_chunk(data, codec, algorithm):
+    """Compress data, keeping it raw when that does not make it smaller."""
+    digest = chunk_digest(data, algorithm)
+    payload = CODECS[codec][0](data)
+    if len(payload) >= len(data):
+        return PackedChunk(data, data, 0, digest)
+    return PackedChunk(data, payload, FLAG_COMPRESSED, digest)
+
+
+def _pack_queued(chunk_data, codec, algorithm):
+    global compress_waiting
+    with _compress_lock:
+        compress_waiting -= 1
+    return pack_chunk(chunk_data, codec, algorithm)
+
+
+def pack_ahead(chunks, channel, lookahead, packed=None):
+    """Yield (chunk_num, PackedChunk), compressing up to lookahead chunks ahead on compress_pool.
+
+    The pool works on the next chunks while the current ones are on the
+    wire; zlib and friends release the GIL while they compress. packed,
+    if given, is a cache of earlier results: packed.get(chunk_num, data)
+    returns a PackedChunk or None, and packed.put(chunk_num, chunk) is
+    offered every chunk that had to be packed.
+    """
+    global compress_waiting
+    pending = deque()  # (chunk_num, future, whether it needs no packing)
+
+    def result(chunk_num, future, hit):
+        chunk = future.result()
+        if packed is not None and not hit:
+            packed.put(chunk_num, chunk)
+        return chunk
+
+    for chunk_num, chunk_data in chunks:
+        if isinstance(chunk_data, PackedChunk):
+            chunk = chunk_data  # Left uncompressed by compress_selected
+        else:
+            chunk = packed.get(chunk_num, chunk_data) if packed is not None else None
+        if chunk is None:
+            with _compress_lock:
+                compress_waiting += 1
+            future = compress_pool.submit(_pack_queued, chunk_data, channel.codec, channel.digest)
+        else:
+            future = Future()
+            future.set_result(chunk)
+        pending.append((chunk_num, future, chunk is not None))
+        if len(pending) >= lookahead:
+            chunk_num, future, hit = pending.popleft()
+            yield chunk_num, result(chunk_num, future, hit)
+    for chunk_num, future, hit in pending:
+        yield chunk_num, result(chunk_num, future, hit)
+
+
+def compress_selected(chunks, worth, algorithm):
+    """Yield chunks for send_chunks, those whose worth[chunk_num] is false as PackedChunks it sends uncompressed."""
+    for chunk_num, chunk_data in chunks:
+        if worth[chunk_num]:
+            yield chunk_num, chunk_data
+        else:
+            yield chunk_num, PackedChunk(chunk_data, chunk_data, 0, chunk_digest(chunk_data, algorithm))
+
+
+def raw_data(chunk_data):
+    return chunk_data.data if isinstance(chunk_data, PackedChunk) else chunk_data
+
+
+def wire_size(chunk_data):
+    return len(chunk_data.payload) if isinstance(chunk_data, PackedChunk) else len(chunk_data)
+
+
+def should_compress(filename):
+    return os.path.splitext(filename)[1].lower() not in COMPRESSED_EXTENSIONS
+
+
+def send_chunk(channel, chunk_num, chunk_data, transfer_id=0, msg_type=MSG_DATA, digest=b''):
+    if isinstance(chunk_data, PackedChunk):
+        header = encode_chunk_header(channel.version, msg_type, transfer_id, chunk_num, len(chunk_data.payload), chunk_data.digest, chunk_data.flags)
+        if len(chunk_data.payload) <= SMALL_WRITE:
+            channel.sock.sendall(header + chunk_data.payload)
+        else:
+            channel.sock.sendall(header)
+            channel.sock.sendall(chunk_data.payload)
+    elif isinstance(chunk_data, FileRegion):
+        # The header goes out from Python, the payload is sent by the kernel.
+        channel.sock.sendall(encode_chunk_header(channel.version, msg_type, transfer_id, chunk_num, chunk_data.length, chunk_data.digest))
+        channel.sock.sendfile(chunk_data.f, chunk_data.offset, chunk_data.length)
+    else:
+        if msg_type == MSG_DATA or channel.version < 2:
+            digest = chunk_digest(chunk_data, channel.digest)
+        header = encode_chunk_header(channel.version, msg_type, transfer_id, chunk_num, len(chunk_data), digest)
+        if len(chunk_data) <= SMALL_WRITE:
+            channel.sock.sendall(header + bytes(chunk_data))
+        else:
+            channel.sock.sendall(header)
+            channel.sock.sendall(chunk_data)
+
+
+def send_chunks(channel, chunks, window_size=WINDOW_SIZE, on_ack=None, file_hash=None, compress=False, pace=None, observe=None, packed=None):
+    """Send (chunk_num, chunk_data) pairs with up to window_size of them unacknowledged.
+
+    The receiver answers every chunk frame with ACK or NAK in the order the
+    frames arrived, so replies are matched against the in-flight queue
+    first-in first-out and only NAKed chunks are sent again. The end frame
+    goes out once every data chunk has been acknowledged. chunk_data may be
+    bytes or a FileRegion. When the chunks are the whole file in order,
+    file_hash is fed each of them and its digest rides in the end frame.
+    With compress, and a codec negotiated on the channel, byte chunks are
+    compressed ahead of time on the compression pool, reusing what the
+    packed cache holds (see pack_ahead). pace(size), if
+    given, is called with the bytes about to go out before every data
+    frame and may block to hold the transfer to a rate. observe(size, ok,
+    seconds), if given, is called for every ACK or NAK with the time since
+    that frame went out. Returns the number of data chunks sent.
+    """
+    transfer_id = next(channel.transfer_ids)
+    if compress and channel.codec and channel.version >= 2:
+        chunks = pack_ahead(chunks, channel, window_size, packed)
+    chunks = iter(chunks)
+    in_flight = deque()
+    sent_at = deque()  # Send times of in_flight, only kept for observe
+    retransmit = deque()
+    failures = {}
+    exhausted = False
+    chunk_count = 0
+
+    while True:
+        while len(in_flight) < window_size:
+            if retransmit:
+                chunk = retransmit.popleft()
+            elif not exhausted:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                chunk_count += 1
+                if file_hash is not None:
+                    file_hash.update(raw_data(chunk[1]))
+            else:
+                break
+            if pace:
+                pace(wire_size(chunk[1]))
+            send_chunk(channel, *chunk, transfer_id)
+            in_flight.append(chunk)
+            if observe:
+                sent_at.append(time.perf_counter())
+
+        if not in_flight:
+            break
+
+        ok, acked_num = channel.receive_ack()
+        chunk_num, chunk_data = in_flight.popleft()
+        if acked_num is not None and acked_num != chunk_num:
+            channel.abort()
+            raise ConnectionError(f"Reply for chunk {acked_num} while chunk {chunk_num} was expected")
+        if observe:
+            observe(wire_size(chunk_data), ok, time.perf_counter() - sent_at.popleft())
+        if ok:
+            if on_ack:
+                on_ack(chunk_num, raw_data(chunk_data))
+            continue
+
+        failures[chunk_num] = failures.get(chunk_num, 0) + 1
+        if failures[chunk_num] >= MAX_RETRIES:
+            channel.abort()
+            raise ConnectionError(f"Chunk {chunk_num} rejected {MAX_RETRIES} times")
+        logging.warning(f"Chunk {chunk_num} rejected by receiver, retransmitting.")
+        retransmit.append((chunk_num, chunk_data))
+
+    file_digest = file_hash.digest() if file_hash is not None else b''
+    send_chunk(channel, chunk_count, b'', transfer_id, MSG_END, file_digest)
+    if not channel.receive_ack()[0]:
+        raise ConnectionError("End of transfer was rejected by the receiver")
+    return chunk_count
+
+
+class FileVerifier:
+    """Receiving side of the whole-file digest, fed chunks as they arrive.
+
+    Chunks are hashed while they come in order. Once one arrives out of
+    order, e.g. after a retransmission, the file is read back from disk at
+    the end instead: length bytes from start, or all of it.
+    """
+
+    def __init__(self, algorithm, start=0, length=None):
+        self.algorithm = algorithm
+        self.start = start
+        self.length = length
+        self.hash = new_digest(algorithm)
+        self.next_chunk = 0
+        self.in_order = True
+        self.verified = None  # The digest, once it matched
+
+    def update(self, chunk_num, data):
+        if self.in_order and chunk_num == self.next_chunk:
+            self.hash.update(data)
+            self.next_chunk += 1
+        else:
+            self.in_order = False
+
+    def verify(self, expected, f, chunk_size):
+        if self.in_order:
+            digest = self.hash.digest()
+        else:
+            file_hash = new_digest(self.algorithm)
+            f.flush()
+            f.seek(self.start)
+            remaining = self.length
+            while remaining is None or remaining > 0:
+                chunk_data = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk_data:
+                    break
+                file_hash.update(chunk_data)
+                if remaining is not None:
+                    remaining -= len(chunk_data)
+            digest = file_hash.digest()
+        if digest == expected:
+            self.verified = digest
+        return self.verified is not None
+
+
+def read_chunks(f, chunk_size, first_chunk=0, last_chunk=None):
+    """Yield (chunk_num, chunk_data) from f, optionally limited to chunks [first_chunk, last_chunk)."""
+    chunk_num = first_chunk
+    f.seek(first_chunk * chunk_size)
+    while last_chunk is None or chunk_num < last_chunk:
+        chunk_data = f.read(chunk_size)
+        if not chunk_data:
+            return
+        yield chunk_num, chunk_data
+        chunk_num += 1
+
+
+def split_ranges(filesize, chunk_size, connections):
+    """Split a file into at most `connections` contiguous [first_chunk, last_chunk) ranges."""
+    chunk_count = (filesize + chunk_size - 1) // chunk_size
+    per_connection = max(1, (chunk_count + connections - 1) // connections)
+    return [(first, min(first + per_connection, chunk_count))
+            for first in range(0, chunk_count, per_connection)]
+
+
+def read_ranges(f, chunk_size, ranges):
+    """Yield the chunks of every [first_chunk, last_chunk) range in turn."""
+    for first_chunk, last_chunk in ranges:
+        yield from read_chunks(f, chunk_size, first_chunk, last_chunk)
+
+
+def read_byte_ranges(f, chunk_size, ranges):
+    """Yield (chunk_num, chunk_data) cutting the bytes of every (offset, length) range of f, back to back, into chunks."""
+    parts = []
+    size = 0
+    chunk_num = 0
+    for offset, length in ranges:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(length, chunk_size - size))
+            if not data:
+                raise ValueError(f"range at {offset} runs past the end of the file")
+            parts.append(data)
+            size += len(data)
+            length -= len(data)
+            if size == chunk_size:
+                yield chunk_num, parts[0] if len(parts) == 1 else b''.join(parts)
+                parts = []
+                size = 0
+                chunk_num += 1
+    if parts:
+        yield chunk_num, parts[0] if len(parts) == 1 else b''.join(parts)
+
+
+def encode_ranges(ranges):
+    return ','.join(f"{first}-{last}" for first, last in ranges).encode()
+
+
+def decode_ranges(data):
+    if not data:
+        return []
+    return [tuple(int(n) for n in r.split('-')) for r in data.decode().split(',')]
+
+
+class ChunkManifest:
+    """Record of the chunks of a partial file that were received and verified.
+
+    The file holds the expected size ('-' if not known yet) on its first line,
+    optionally followed by a token naming the version of the source file, and
+    one chunk number per line after that. Chunks are appended as they are
+    written, so a dropped transfer can pick up where it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.filesize = None
+        self.token = None
+        self.chunks = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                header = f.readline().split()
+                lines = f.read().split()
+            if header:
+                self.filesize = None if header[0] == '-' else int(header[0])
+                self.token = header[1] if len(header) > 1 else None
+                self.chunks = {int(n) for n in lines}
+
+    def reset(self, filesize=None, token=None):
+        self.filesize = filesize
+        self.token = token
+        self.chunks = set()
+        self._rewrite()
+
+    def set_filesize(self, filesize):
+        self.filesize = filesize
+        self._rewrite()
+
+    def _rewrite(self):
+        with open(self.path, 'w') as f:
+            f.write('-' if self.filesize is None else str(self.filesize))
+            if self.token:
+                f.write(f" {self.token}")
+            f.write('\n')
+            f.writelines(f"{n}\n" for n in sorted(self.chunks))
+
+    def add(self, chunk_num):
+        self.chunks.add(chunk_num)
+        with open(self.path, 'a') as f:
+            f.write(f"{chunk_num}\n")
+
+    def chunk_count(self, chunk_size):
+        return (self.filesize + chunk_size - 1) // chunk_size
+
+    def missing(self, chunk_size):
+        """Return the [first_chunk, last_chunk) ranges that have not been received yet."""
+        ranges = []
+        first = None
+        for chunk_num in range(self.chunk_count(chunk_size)):
+            if chunk_num in self.chunks:
+                if first is not None:
+                    ranges.append((first, chunk_num))
+                    first = None
+            elif first is None:
+                first = chunk_num
+        if first is not None:
+            ranges.append((first, self.chunk_count(chunk_size)))
+        return ranges
+
+    def is_complete(self, chunk_size):
+        return self.filesize is not None and not self.missing(chunk_size)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,33 +1,90 @@
 import socket
-import struct
 import os
 import threading
-import hashlib
 import logging
 import time
-import tkinter as tk
-from tkinter import scrolledtext
+import uuid
+import json
+import queue
+import argparse
 from datetime import datetime
+from contextlib import contextmanager
+import protocol
+import events
+import dedup
+import delta
+import dirindex
+import batch
+import shaping
+import telemetry
+import connections
+import mapcache
+import chunkcache
+from async_server import AsyncServer
+
+try:
+    import tkinter as tk
+    from tkinter import scrolledtext
+except ImportError:  # Display-less hosts can still run with --headless
+    tk = None
 
 SERVER_IP = socket.gethostbyname(socket.gethostname())
 SERVER_PORT = 5000
 BUFFER_SIZE = 1024 * 1024
 SERVER_FOLDER = "server"
+MAX_LOG_LINES = 2000  # Lines kept in the ServerUI log before the oldest are dropped
+LOG_FLUSH_MS = 200
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+class TransferSession:
+    def __init__(self, session_id, direction, filename, filesize, owner):
+        self.session_id = session_id
+        self.direction = direction
+        self.filename = filename
+        self.filesize = filesize
+        self.owner = owner  # Control connection that opened the session
+        self.temp_name = f".{filename}.{session_id}.part"
+        self.chunk_count = (filesize + BUFFER_SIZE - 1) // BUFFER_SIZE
+        self.received = 0
+        self.failed = False
+        self.receiving = 0  # Data connections still inside join_session
+        self.lock = threading.Condition()
+
+
 class Server:
-    def __init__(self, server_ip, server_port, server_folder, ui):
+    def __init__(self, server_ip, server_port, server_folder, ui=None, workers=None, window_size=protocol.WINDOW_SIZE, zero_copy=True, shaper=None, metrics=None, chunk_cache=None):
         self.server_ip = server_ip
         self.server_port = server_port
         self.server_folder = server_folder
-        self.ui = ui
+        self.ui = ui or events.LoggingSink()  # Event sink: ServerUI, events.LoggingSink, ...
+        # Optional cap on connections served at once; the rest wait in the listen backlog.
+        self.worker_slots = threading.BoundedSemaphore(workers) if workers else None
+        self.accept_thread = None
         self.server_socket = None
-        self.client_sockets = []
-        self.lock = threading.Lock()
-        self.client_count = 0
+        self.connections = connections.ConnectionRegistry()  # Socket -> Connection with its channel and stats
+        self.sessions = {}
+        self.partial_writers = {}  # Name -> socket writing its resumable .part file
+        self.session_lock = threading.Lock()  # Guards sessions and partial_writers; client data never waits on it
         self.running = False
+        self.window_size = window_size
+        self.zero_copy = zero_copy  # Send downloads with socket.sendfile when chunk digests are stored
+        self.store = dedup.ChunkStore(server_folder)  # Chunks of files uploaded with the 'k' action
+        self.index = dirindex.DirectoryIndex(server_folder)
+        self.maps = mapcache.MapCache()  # Shared read-only maps of files this server wrote, being downloaded
+        self.chunks = chunk_cache or chunkcache.ChunkCache()  # Parsed digest sidecars and compressed chunks
+        self.shaper = shaper or shaping.Shaper()  # Send rate limits, adjustable while running
+        self.metrics = metrics or telemetry.NULL_METRICS  # See telemetry.serve for the HTTP endpoint
+        self.metrics.gauge('clients_connected', "Open client connections", function=lambda: len(self.connections))
+        self.metrics.gauge('sessions_open', "Parallel transfer sessions not closed yet", function=lambda: len(self.sessions))
+        self.metrics.gauge('chunk_cache_bytes', "Bytes held by the chunk cache", function=lambda: self.chunks.size)
+        self.metrics.gauge('compress_queue_depth', "Chunks waiting for the compression pool",
+                           function=lambda: protocol.compress_waiting)
+
+    @property
+    def client_count(self):
+        return len(self.connections)
 
     def start(self):
         if self.running:
@@ -39,6 +96,8 @@ class Server:
             self.ui.log_message(f"\"{self.server_folder}\" Created")
         else:
             self.ui.log_message(f"\"{self.server_folder}\" Found")
+        # Chunks left behind by uploads cut short by a crash
+        self.store.collect_garbage()
 
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.server_ip, self.server_port))
@@ -50,13 +109,14 @@ class Server:
         def accept_connections():
             try:
                 while self.running:
+                    if self.worker_slots:
+                        self.worker_slots.acquire()
                     client_socket, address = self.server_socket.accept()
-                    with self.lock:
-                        self.client_sockets.append((client_socket, address))
-                    self.ui.log_message(f"Accepted connection from {address[0]}:{address[1]}")
-                    self.client_count += 1
+                    protocol.no_delay(client_socket)
+                    connection = self.connections.add(client_socket, address)
+                    self.ui.log_message(f"Accepted connection from {connection.label}")
                     self.ui.update_client_count(self.client_count)
-                    client_handler = threading.Thread(target=self.handle_client, args=(client_socket, address))
+                    client_handler = threading.Thread(target=self.handle_client, args=(client_socket, address), daemon=True)
                     client_handler.start()
             except OSError as e:
                 if e.errno == 9:  # Bad file descriptor error, which is expected when the server socket is closed
@@ -69,7 +129,13 @@ class Server:
                 if self.server_socket:
                     self.server_socket.close()
 
-        threading.Thread(target=accept_connections, daemon=True).start()
+        self.accept_thread = threading.Thread(target=accept_connections, daemon=True)
+        self.accept_thread.start()
+
+    def serve_forever(self):
+        """Start the server and block the calling thread until it is stopped."""
+        self.start()
+        self.accept_thread.join()
 
     def stop(self):
         if not self.running:
@@ -86,137 +152,749 @@ class Server:
             self.server_socket.close()
             self.server_socket = None
 
-        with self.lock:
-            for client_socket, _ in self.client_sockets:
-                client_socket.close()
-            self.client_sockets = []
+        for connection in self.connections.all():
+            connection.sock.close()
 
         self.ui.log_message("Server stopped.")
 
     def send_data(self, client_socket, data):
-        data_len = len(data)
-        client_socket.sendall(struct.pack('!I', data_len))
-        client_socket.sendall(data)
+        protocol.send_data(client_socket, data)
 
     def receive_data(self, client_socket):
-        data_len_bytes = client_socket.recv(4)
-        if not data_len_bytes:
-            return None
-        data_len = struct.unpack('!I', data_len_bytes)[0]
-        data = b''
-        while len(data) < data_len:
-            packet = client_socket.recv(data_len - len(data))
-            if not packet:
-                return None
-            data += packet
-        return data
+        return self.connections[client_socket].channel.receive_data()
 
     def calculate_checksum(self, data):
-        return hashlib.sha256(data).hexdigest()
-
-    def send_chunk(self, client_socket, chunk_num, chunk_data):
-        retries = 3  # Maximum retry attempts
-        while retries > 0:
-            try:
-                checksum = self.calculate_checksum(chunk_data)
-                data_with_checksum_chunk_num = checksum.encode() + b'::' + str(chunk_num).encode() + b'::' + chunk_data
-                with self.lock:
-                    self.send_data(client_socket, data_with_checksum_chunk_num)
-                    ack = self.receive_data(client_socket)
-                    if ack.decode() == "ACK":
-                        client_address = next(addr for sock, addr in self.client_sockets if sock == client_socket)
-                        self.ui.log_message(f"Chunk {chunk_num} uploaded successfully to {client_address[0]}:{client_address[1]} at {datetime.now()}.")
-                        return True  # Success, no need to retry
-            except Exception as e:
-                self.ui.log_message(f"Error uploading chunk {chunk_num}: {e}")
-                retries -= 1
-        client_address = next(addr for sock, addr in self.client_sockets if sock == client_socket)
-        self.ui.log_message(f"Failed to upload chunk {chunk_num} after {retries} retries to {client_address[0]}:{client_address[1]} at {datetime.now()}.")
-        return False
+        return protocol.calculate_checksum(data)
 
     def receive_chunk(self, client_socket):
+        channel = self.connections[client_socket].channel
         retries = 3  # Maximum retry attempts
         while retries > 0:
             try:
-                data_with_checksum = self.receive_data(client_socket)
-                if data_with_checksum:
-                    received_checksum, chunk_num, chunk_data = data_with_checksum.split(b'::', 2)
-                    calculated_checksum = self.calculate_checksum(chunk_data)
-                    if received_checksum.decode() == calculated_checksum:
-                        self.send_data(client_socket, b"ACK")
-                        client_address = next(addr for sock, addr in self.client_sockets if sock == client_socket)
-                        self.ui.log_message(f"Chunk {chunk_num.decode()} received successfully from {client_address[0]}:{client_address[1]} at {datetime.now()}.")
-                        return chunk_num, chunk_data
+                frame = channel.receive_frame()
+                if frame is None:
+                    break
+                chunk = protocol.decode_chunk(frame, channel.digest, channel.codec)
+                if chunk.msg_type == protocol.MSG_ABORT:
+                    self.ui.log_message("Sender aborted the transfer.")
+                    break
+                if chunk.valid:
+                    # END frames are acknowledged by receive_chunks once the file is checked.
+                    if chunk.msg_type != protocol.MSG_END:
+                        channel.send_ack(chunk, True)
+                    return chunk
+                self.metrics.checksum_failures.inc()
+                self.ui.log_message(f"Checksum mismatch on chunk {chunk.chunk_num}, requesting retransmission.")
+                channel.send_ack(chunk, False)
+            except ValueError as e:
+                self.metrics.checksum_failures.inc()
+                self.ui.log_message(f"Malformed chunk: {e}")
+                self.send_data(client_socket, b"NAK")
             except Exception as e:
                 self.ui.log_message(f"Error receiving chunk: {e}")
-                retries -= 1
-        client_address = next(addr for sock, addr in self.client_sockets if sock == client_socket)
-        self.ui.log_message(f"Failed to receive chunk after {retries} retries from {client_address[0]}:{client_address[1]} at {datetime.now()}.")
+                break
+            retries -= 1
+        self.ui.log_message(f"Failed to receive chunk from {self.connections[client_socket].label} at {datetime.now()}, closing the connection.")
+        channel.abort()
         return None
 
-    def receive_file(self, client_socket, filename):
-        file_chunks = []
+    def receive_chunks(self, client_socket, f, manifest=None, progress=None, digests=None, verifier=None, write=None, trace=telemetry.NULL):
+        """Write incoming chunks to their offsets in f until the end frame; returns the chunk count or None.
+
+        With a verifier, a whole-file digest in the end frame is checked
+        before the end frame is acknowledged. write(chunk_num, payload), if
+        given, takes the chunks instead of f. The end frame must carry the
+        number of chunks that arrived.
+        """
+        connection = self.connections[client_socket]
+        channel = connection.channel
+        chunk_count = 0
+        transfer_id = None
+        timing = trace is not telemetry.NULL
         while True:
-            chunk_num, chunk_data = self.receive_chunk(client_socket)
-            if not chunk_data:
-                break
-            file_chunks.append((int(chunk_num.decode()), chunk_data))
+            if timing:
+                start = time.perf_counter()
+            chunk = self.receive_chunk(client_socket)
+            if chunk is None:
+                return None
+            if transfer_id is None:
+                transfer_id = chunk.transfer_id
+            elif chunk.transfer_id != transfer_id:
+                self.ui.log_message(f"Chunk {chunk.chunk_num} belongs to transfer {chunk.transfer_id}, expected {transfer_id}.")
+                channel.abort()
+                return None
+            if chunk.msg_type == protocol.MSG_END:
+                if chunk.chunk_num != chunk_count:
+                    self.ui.log_message(f"Sender reports {chunk.chunk_num} chunks, {chunk_count} arrived.")
+                    channel.send_ack(chunk, False)
+                    return None
+                if verifier and chunk.digest:
+                    with trace.span('verify'):
+                        verified = verifier.verify(chunk.digest, f, BUFFER_SIZE)
+                    if not verified:
+                        self.ui.log_message(f"Whole-file {verifier.algorithm} digest mismatch after {chunk_count} chunks.")
+                        channel.send_ack(chunk, False)
+                        if manifest:
+                            manifest.reset(manifest.filesize, manifest.token)
+                        return None
+                channel.send_ack(chunk, True)
+                return chunk_count
+            if write:
+                write(chunk.chunk_num, chunk.payload)
+            else:
+                f.seek(chunk.chunk_num * BUFFER_SIZE)
+                f.write(chunk.payload)
+            if manifest:
+                manifest.add(chunk.chunk_num)
+            if digests is not None:
+                digests[chunk.chunk_num] = chunk.digest
+            if verifier:
+                verifier.update(chunk.chunk_num, chunk.payload)
+            if progress:
+                progress.chunk(len(chunk.payload))
+            connection.received(len(chunk.payload))
+            self.metrics.bytes_received.inc(len(chunk.payload))
+            if timing:
+                trace.record('chunk', start)
+            chunk_count += 1
+
+    def partial_paths(self, filename):
+        return (os.path.join(self.server_folder, f".{filename}.part"),
+                os.path.join(self.server_folder, f".{filename}.manifest"))
+
+    def upload_path(self, filename, kind='part'):
+        """Return a temp path of filename that no other upload writes to."""
+        return os.path.join(self.server_folder, f".{filename}.{uuid.uuid4().hex}.{kind}")
 
-        filename = os.path.join(self.server_folder, filename)
-        with open(filename, 'wb') as f:
-            for chunk_num, chunk_data in sorted(file_chunks):
-                f.write(chunk_data)
+    def claim_partial(self, client_socket, filename):
+        """Reserve the resumable .part file of filename for client_socket; False while another connection holds it."""
+        with self.session_lock:
+            return self.partial_writers.setdefault(filename, client_socket) is client_socket
 
-        client_address = next(addr for sock, addr in self.client_sockets if sock == client_socket)
-        self.ui.log_message(f"File {os.path.basename(filename)} received successfully from {client_address[0]}:{client_address[1]} at {datetime.now()}.")
+    def release_partials(self, client_socket, filename=None):
+        with self.session_lock:
+            for name in [name for name, owner in self.partial_writers.items() if owner is client_socket and filename in (None, name)]:
+                del self.partial_writers[name]
 
-    def send_file(self, client_socket, filename):
+    def receive_file(self, client_socket, filename, resume=False, trace=telemetry.NULL):
+        # Chunks are written straight to their offset in a temp file, so memory
+        # use stays at one chunk no matter how large the upload is. Plain
+        # uploads each get their own temp file; resumed ones ('a') share the
+        # .part file and manifest of the name, one connection at a time.
+        # Version 2 clients get a final "success" once the file is in place,
+        # or "failure" if a resumed upload still lacks chunks.
+        if not resume:
+            self.receive_whole(client_socket, filename, trace)
+            return
+        client_address = self.connections[client_socket].address
+        channel = self.connections[client_socket].channel
+        if not self.claim_partial(client_socket, filename):
+            self.receive_chunks(client_socket, None, write=lambda chunk_num, payload: None, trace=trace)
+            self.ui.log_message(f"Resumed upload of {filename} from {client_address[0]}:{client_address[1]} refused, another connection is writing it.")
+            if channel.version >= 2:
+                self.send_data(client_socket, b"failure")
+            return
         try:
-            self.send_data(client_socket, str(os.path.getsize(filename)).encode())
-            threads = []
-            with open(filename, 'rb') as f:
-                chunk_num = 0
-                while True:
-                    chunk_data = f.read(BUFFER_SIZE)
-                    if not chunk_data:
-                        time.sleep(0.2)
-                        thread = threading.Thread(target=self.send_chunk, args=(client_socket, chunk_num, "".encode()))
-                        thread.start()
-                        threads.append(thread)
-                        break
-                    thread = threading.Thread(target=self.send_chunk, args=(client_socket, chunk_num, chunk_data))
-                    thread.start()
-                    threads.append(thread)
-                    chunk_num += 1
-
-            for thread in threads:
-                thread.join()
-
-            client_address = next(addr for sock, addr in self.client_sockets if sock == client_socket)
-            self.ui.log_message(f"File {os.path.basename(filename)} sent successfully to {client_address[0]}:{client_address[1]} at {datetime.now()}.")
+            self.receive_partial(client_socket, filename, trace)
+        finally:
+            self.release_partials(client_socket, filename)
+
+    def receive_whole(self, client_socket, filename, trace=telemetry.NULL):
+        filepath = os.path.join(self.server_folder, filename)
+        temp_path = self.upload_path(filename)
+        client_address = self.connections[client_socket].address
+        progress = events.TransferProgress(self.ui, f"Receiving {filename} from {client_address[0]}:{client_address[1]}")
+        channel = self.connections[client_socket].channel
+        digests = {}
+        verifier = protocol.FileVerifier(channel.file_digest) if channel.file_digest else None
+        with open(temp_path, 'w+b') as f:
+            chunk_count = self.receive_chunks(client_socket, f, None, progress, digests, verifier, trace=trace)
+            close_started = time.perf_counter()
+        trace.record('close', close_started)
+
+        if chunk_count is None:
+            os.remove(temp_path)
+            self.ui.log_message(f"File {filename} upload from {client_address[0]}:{client_address[1]} interrupted at {datetime.now()}.")
+            return
+
+        with trace.span('rename'):
+            # A rename keeps inode, size and mtime, so this names the file only
+            # while it is still the one this upload wrote.
+            version = chunkcache.file_version(temp_path)
+            self.forget_cached(filepath)
+            os.replace(temp_path, filepath)
+            self.maps.adopt(filepath)
+            dedup.discard_recipe(filepath, self.store)
+        file_digest = verifier.verified if verifier else None
+        with trace.span('digests'):
+            self.save_chunk_digests(filepath, channel.digest, [digests[n] for n in range(chunk_count)],
+                                    channel.file_digest if file_digest else None, file_digest, version)
+        verified = file_digest if verifier and verifier.algorithm == 'sha256' else None
+        self.index.update(filename, verified.hex() if verified else None)
+        self.ui.log_message(f"File {filename} received successfully from {client_address[0]}:{client_address[1]} at {datetime.now()} ({progress.summary()}).")
+        if channel.version >= 2:
+            self.send_data(client_socket, b"success")
+
+    def receive_partial(self, client_socket, filename, trace=telemetry.NULL):
+        # A resumed upload only sees some of the chunks, so its digests are built on first download instead.
+        filepath = os.path.join(self.server_folder, filename)
+        temp_path, manifest_path = self.partial_paths(filename)
+        manifest = protocol.ChunkManifest(manifest_path)
+        client_address = self.connections[client_socket].address
+        progress = events.TransferProgress(self.ui, f"Receiving {filename} from {client_address[0]}:{client_address[1]}")
+        if os.path.exists(temp_path):
+            mode = 'r+b'
+        else:
+            mode = 'w+b'
+            manifest.reset(manifest.filesize, manifest.token)
+        channel = self.connections[client_socket].channel
+        with open(temp_path, mode) as f:
+            chunk_count = self.receive_chunks(client_socket, f, manifest, progress, trace=trace)
+            if manifest.is_complete(BUFFER_SIZE):
+                f.truncate(manifest.filesize)
+            close_started = time.perf_counter()
+        trace.record('close', close_started)
+
+        if chunk_count is None:
+            self.ui.log_message(f"File {filename} upload from {client_address[0]}:{client_address[1]} interrupted at {datetime.now()}, kept {len(manifest.chunks)} chunks for resume.")
+            return
+        if not manifest.is_complete(BUFFER_SIZE):
+            self.ui.log_message(f"File {filename} from {client_address[0]}:{client_address[1]} still has missing chunks at {datetime.now()}.")
+            if channel.version >= 2:
+                self.send_data(client_socket, b"failure")
+            return
+
+        with trace.span('rename'):
+            manifest.remove()
+            self.forget_cached(filepath)
+            os.replace(temp_path, filepath)
+            self.maps.adopt(filepath)
+            dedup.discard_recipe(filepath, self.store)
+        self.index.update(filename)
+        self.ui.log_message(f"File {filename} received successfully from {client_address[0]}:{client_address[1]} at {datetime.now()} ({progress.summary()}).")
+        if channel.version >= 2:
+            self.send_data(client_socket, b"success")
+
+    def receive_deduplicated(self, client_socket, filename, recipe, trace=telemetry.NULL):
+        """Take a file uploaded as a recipe, receiving only the chunks the store does not hold yet.
+
+        The reply to the recipe is the ranges of recipe indices to send, the
+        chunks then come in with their index as chunk number, and the final
+        reply is "success" or "failure".
+        """
+        filepath = os.path.join(self.server_folder, filename)
+        client_address = self.connections[client_socket].address
+        progress = events.TransferProgress(self.ui, f"Receiving new chunks of {filename} from {client_address[0]}:{client_address[1]}")
+
+        def write(chunk_num, payload):
+            digest, length = recipe.entries[chunk_num]
+            if len(payload) != length or not self.store.put(digest, payload):
+                self.ui.log_message(f"Chunk {chunk_num} of {filename} does not match its recipe entry.")
+
+        # Pinned, the chunks this upload relies on survive other uploads and
+        # deletes dropping the last recipe that used them.
+        with self.store.pinned(recipe):
+            missing = recipe.missing(self.store)
+            self.send_data(client_socket, protocol.encode_ranges(missing))
+            chunk_count = self.receive_chunks(client_socket, None, progress=progress, write=write, trace=trace)
+            saved = chunk_count is not None and self.store.save_recipe(recipe, dedup.recipe_path(filepath))
+        if not saved:
+            self.ui.log_message(f"File {filename} upload from {client_address[0]}:{client_address[1]} is missing chunks at {datetime.now()}.")
+            self.send_data(client_socket, b"failure")
+            return
+
+        self.forget_cached(filepath)
+        for path in (filepath, self.digest_path(filepath)):
+            if os.path.exists(path):
+                os.remove(path)
+        self.index.update(filename)
+        self.ui.log_message(f"File {filename} stored from {client_address[0]}:{client_address[1]} at {datetime.now()}: "
+                            f"{chunk_count} of {len(recipe.entries)} chunks were new ({progress.summary()}).")
+        self.send_data(client_socket, b"success")
+
+    def receive_delta(self, client_socket, filename, trace=telemetry.NULL):
+        """Update an existing file from a delta against the copy held here.
+
+        The server replies with "<block size>::<size>" and the block
+        signatures of its copy, or "File not found.". The client answers
+        with delta operations as chunks, then "<size>::<sha256>" of the new
+        file, or "<size>::" to give up on the delta; the reply is "success"
+        once the rebuilt file matches it, else "failure".
+        """
+        filepath = os.path.join(self.server_folder, filename)
+        try:
+            filesize = dedup.stored_size(filepath)
+        except FileNotFoundError:
+            self.send_data(client_socket, b'File not found.')
+            return
+        client_address = self.connections[client_socket].address
+        block_size = delta.block_size_for(filesize)
+        with dedup.open_stored(filepath, self.store) as source:
+            signatures = delta.signatures(source, block_size)
+        self.send_data(client_socket, f"{block_size}::{filesize}".encode())
+        self.send_data(client_socket, signatures)
+
+        progress = events.TransferProgress(self.ui, f"Receiving delta of {filename} from {client_address[0]}:{client_address[1]}")
+        temp_path = self.upload_path(filename, 'delta')
+        with dedup.open_stored(filepath, self.store) as source, open(temp_path, 'w+b') as target:
+            def write(chunk_num, payload):
+                delta.apply_op(payload, source, target, block_size)
+
+            chunk_count = self.receive_chunks(client_socket, target, progress=progress, write=write, trace=trace)
+            if chunk_count is not None:
+                new_size, new_digest = self.receive_data(client_socket).decode().split('::')
+                target.truncate(int(new_size))
+                matched = bool(new_digest) and delta.file_digest(target) == new_digest
+
+        if chunk_count is None or not matched:
+            os.remove(temp_path)
+            self.ui.log_message(f"Delta upload of {filename} from {client_address[0]}:{client_address[1]} failed at {datetime.now()}.")
+            if chunk_count is not None:
+                self.send_data(client_socket, b"failure")
+            return
+
+        self.forget_cached(filepath)
+        os.replace(temp_path, filepath)
+        self.maps.adopt(filepath)
+        dedup.discard_recipe(filepath, self.store)
+        self.index.update(filename, new_digest)
+        self.ui.log_message(f"File {filename} updated from a delta sent by {client_address[0]}:{client_address[1]} at {datetime.now()} ({progress.summary()}).")
+        self.send_data(client_socket, b"success")
+
+    def receive_batch(self, client_socket, manifest, trace=telemetry.NULL):
+        """Store the files of a batch upload, recreating their folders.
+
+        The reply to the manifest is "ok" or the reason it was refused; the
+        files then arrive as one chunk stream and the final reply is
+        "success" or "failure".
+        """
+        client_address = self.connections[client_socket].address
+        try:
+            writer = batch.BatchWriter(self.server_folder, manifest, BUFFER_SIZE)
+            writer.prepare()
+        except (ValueError, OSError) as e:
+            self.ui.log_message(f"Batch upload from {client_address[0]}:{client_address[1]} refused: {e}")
+            self.send_data(client_socket, str(e).encode())
+            return
+        self.send_data(client_socket, b"ok")
+
+        progress = events.TransferProgress(self.ui, f"Receiving a batch of {len(manifest)} files from {client_address[0]}:{client_address[1]}")
+        try:
+            chunk_count = self.receive_chunks(client_socket, None, progress=progress, write=writer.write, trace=trace)
+        finally:
+            writer.close()
+        if chunk_count is None:
+            writer.abort()
+            self.ui.log_message(f"Batch upload from {client_address[0]}:{client_address[1]} interrupted at {datetime.now()}.")
+            return
+
+        for path in writer.paths:
+            self.forget_cached(path)
+        writer.commit()
+        for path in writer.paths:
+            self.maps.adopt(path)
+            dedup.discard_recipe(path, self.store)
+        self.index.invalidate()
+        self.ui.log_message(f"Received a batch of {len(manifest)} files from {client_address[0]}:{client_address[1]} at {datetime.now()} ({progress.summary()}).")
+        self.send_data(client_socket, b"success")
+
+    def send_batch(self, client_socket, names, trace=telemetry.NULL):
+        """Send the named files as one chunk stream, after a [name, size] manifest of those that exist."""
+        connection = self.connections[client_socket]
+        client_address = connection.address
+        manifest = []
+        for name in names:
+            try:
+                manifest.append([name, dedup.stored_size(batch.safe_path(self.server_folder, name))])
+            except (ValueError, FileNotFoundError):
+                self.ui.log_message(f"File {name} not found at {datetime.now()}.")
+        self.send_data(client_socket, json.dumps(manifest).encode())
+
+        progress = events.TransferProgress(self.ui, f"Sending a batch of {len(manifest)} files to {client_address[0]}:{client_address[1]}")
+        files = [(batch.safe_path(self.server_folder, name), size) for name, size in manifest]
+
+        def on_ack(chunk_num, chunk_data):
+            progress.chunk(len(chunk_data))
+            connection.sent(len(chunk_data))
+
+        # Chunks made mostly of already compressed files are sent as they are.
+        worth = batch.compressible_chunks(manifest, BUFFER_SIZE)
+        with batch.ConcatReader(files, lambda path: dedup.open_stored(path, self.store)) as f, self.shaper.flow(client_address[0]) as pace:
+            chunks = protocol.compress_selected(protocol.read_chunks(f, BUFFER_SIZE), worth, connection.channel.digest)
+            protocol.send_chunks(connection.channel, chunks, self.window_size,
+                                 on_ack, compress=any(worth), pace=pace, observe=self.metrics.observer(trace))
+        self.ui.log_message(f"Sent a batch of {len(manifest)} files to {client_address[0]}:{client_address[1]} at {datetime.now()} ({progress.summary()}).")
+
+    def missing_chunks(self, client_socket, filename, filesize, token=None):
+        """Reply with the chunk ranges of filename that a resumed upload still has to send.
+
+        The kept chunks only count for the same size and source token, and the
+        name stays reserved for this connection until its 'a' upload ends;
+        while another connection holds it the reply is "File busy.".
+        """
+        if not self.claim_partial(client_socket, filename):
+            self.ui.log_message(f"File {filename} is being resumed by another connection, refused at {datetime.now()}.")
+            self.send_data(client_socket, b'File busy.')
+            return
+        temp_path, manifest_path = self.partial_paths(filename)
+        manifest = protocol.ChunkManifest(manifest_path)
+        if not os.path.exists(temp_path) or manifest.filesize not in (None, filesize) or manifest.token != token:
+            manifest.reset(filesize, token)
+        elif manifest.filesize is None:
+            manifest.set_filesize(filesize)
+        missing = manifest.missing(BUFFER_SIZE)
+        self.send_data(client_socket, protocol.encode_ranges(missing))
+        self.ui.log_message(f"File {filename}: {len(manifest.chunks)} chunks already received, {len(missing)} ranges missing.")
+
+    def forget_cached(self, filepath):
+        """Drop the map and cached chunks of filepath; call before replacing or deleting it."""
+        self.maps.invalidate(filepath)
+        self.chunks.invalidate(filepath)
+
+    def digest_path(self, filepath):
+        return os.path.join(os.path.dirname(filepath), f".{os.path.basename(filepath)}.digests")
+
+    def save_chunk_digests(self, filepath, algorithm, digests, file_algorithm=None, file_digest=None, version=None):
+        """Store per-chunk checksums beside filepath so downloads can skip hashing.
+
+        The first line is "<size> <mtime_ns> <algorithm> <file_algorithm> <file digest>",
+        the last two being '-' when no whole-file digest is known. With a
+        version from chunkcache.file_version, taken before the digests were
+        computed, nothing is stored unless the file is still that version.
+        """
+        current = chunkcache.file_version(filepath)
+        if current is None or version is not None and current != version:
+            return
+        _, size, mtime_ns = current
+        with open(self.digest_path(filepath), 'w') as f:
+            f.write(f"{size} {mtime_ns} {algorithm} {file_algorithm or '-'} {file_digest.hex() if file_digest else '-'}\n")
+            f.writelines(f"{digest.hex()}\n" for digest in digests)
+        self.index.wrote_internal(self.digest_path(filepath))
+
+    def drop_chunk_digests(self, filepath):
+        self.chunks.invalidate(filepath)
+        if os.path.exists(self.digest_path(filepath)):
+            os.remove(self.digest_path(filepath))
+
+    def load_chunk_digests(self, filepath, algorithm, file_algorithm=None):
+        """Return (chunk digests, whole-file digest) as stored for these algorithms.
+
+        The chunk digests are None if there are none, they use another
+        algorithm or the file changed since; the whole-file digest is None
+        unless one was stored for file_algorithm.
+        """
+        # Parsed sidecars are kept in the chunk cache for as long as the file is unchanged.
+        key = (filepath, chunkcache.file_version(filepath), 'digests', algorithm, file_algorithm)
+        cached = self.chunks.get(key)
+        if cached is not None:
+            return cached
+        try:
+            with open(self.digest_path(filepath)) as f:
+                lines = f.read().split()
+        except FileNotFoundError:
+            return None, None
+        stat = os.stat(filepath)
+        if lines[:3] != [str(stat.st_size), str(stat.st_mtime_ns), algorithm]:
+            return None, None
+        file_digest = bytes.fromhex(lines[4]) if file_algorithm and lines[3] == file_algorithm else None
+        digests = [bytes.fromhex(digest) for digest in lines[5:]]
+        self.chunks.put(key, (digests, file_digest), sum(len(digest) for digest in digests))
+        return digests, file_digest
+
+    def file_regions(self, f, filesize, digests, ranges):
+        for first_chunk, last_chunk in ranges:
+            for chunk_num in range(first_chunk, min(last_chunk, len(digests))):
+                offset = chunk_num * BUFFER_SIZE
+                yield chunk_num, protocol.FileRegion(f, offset, min(BUFFER_SIZE, filesize - offset), digests[chunk_num])
+
+    def hashed_chunks(self, f, digests, ranges):
+        """Yield the chunks in ranges read from f, each carrying its stored digest."""
+        for chunk_num, chunk_data in protocol.read_ranges(f, BUFFER_SIZE, ranges):
+            yield chunk_num, protocol.PackedChunk(chunk_data, chunk_data, 0, digests[chunk_num])
+
+    def send_file(self, client_socket, filename, first_chunk=0, last_chunk=None, send_size=True, ranges=False, trace=telemetry.NULL):
+        try:
+            filesize = dedup.stored_size(filename)
+            if send_size:
+                self.send_data(client_socket, str(filesize).encode())
+            connection = self.connections[client_socket]
+            client_address = connection.address
+            progress = events.TransferProgress(self.ui, f"Sending {os.path.basename(filename)} to {client_address[0]}:{client_address[1]}")
+            if ranges:
+                # Resumed download: the client replies with the ranges it is missing.
+                chunk_ranges = protocol.decode_ranges(self.receive_data(client_socket))
+            else:
+                chunk_count = (filesize + BUFFER_SIZE - 1) // BUFFER_SIZE
+                chunk_ranges = [(first_chunk, chunk_count if last_chunk is None else last_chunk)]
+
+            channel = connection.channel
+            whole_file = not ranges and first_chunk == 0 and last_chunk is None
+            file_hash = channel.new_file_hash() if whole_file else None
+            # Compressed chunks have to pass through Python, and files kept as
+            # recipes are rebuilt from the chunk store, so neither is zero-copy.
+            compress = bool(channel.codec) and protocol.should_compress(filename)
+            regular = os.path.isfile(filename)
+            # Taken before anything is read, so digests of a file changed mid-send are never stored.
+            version = chunkcache.file_version(filename) if regular else None
+            digests, file_digest = self.load_chunk_digests(filename, channel.digest, channel.file_digest) if regular else (None, None)
+            if file_hash is not None and file_digest is None:
+                # The whole-file digest has to be computed from the data once.
+                digests = None
+            if compress:
+                # Packed chunks carry their own digests, computed once per version of the file.
+                digests = None
+                packed = self.chunks.packed(filename, version, channel.codec, channel.digest) if regular else None
+            else:
+                packed = None
+            zero_copy = self.zero_copy and regular and digests is not None
+            # Files without stored digests are hashed while sending and get them for next time.
+            new_digests = {} if regular and not compress and digests is None and whole_file else None
+
+            def on_ack(chunk_num, chunk_data):
+                progress.chunk(len(chunk_data))
+                connection.sent(len(chunk_data))
+                if new_digests is not None:
+                    new_digests[chunk_num] = protocol.chunk_digest(chunk_data, channel.digest)
+
+            # Regions for sendfile need the file itself; chunks that pass through
+            # Python are sliced from the shared map instead of read into copies.
+            if zero_copy:
+                source = dedup.open_stored(filename, self.store)
+            else:
+                source = self.maps.reader(filename, lambda path: dedup.open_stored(path, self.store))
+            if file_hash is not None and file_digest is not None:
+                file_hash = protocol.KnownDigest(file_digest)
+            # All connections from one address share its rate, see shaping.py.
+            with source as f, self.shaper.flow(client_address[0]) as pace:
+                if zero_copy:
+                    chunks = self.file_regions(f, filesize, digests, chunk_ranges)
+                elif digests is not None:
+                    chunks = self.hashed_chunks(f, digests, chunk_ranges)
+                else:
+                    chunks = protocol.read_ranges(f, BUFFER_SIZE, chunk_ranges)
+                try:
+                    protocol.send_chunks(channel, chunks, self.window_size, on_ack, file_hash, compress, pace,
+                                         self.metrics.observer(trace), packed)
+                except ConnectionError as e:
+                    # The receiver rejecting chunks or the end frame sent with stored
+                    # digests means the sidecar does not describe this file; resets
+                    # and broken pipes are subclasses and leave it alone.
+                    if type(e) is ConnectionError and (digests is not None or isinstance(file_hash, protocol.KnownDigest)):
+                        self.ui.log_message(f"Stored digests of {os.path.basename(filename)} were rejected, dropping them.")
+                        self.drop_chunk_digests(filename)
+                    raise
+
+            if new_digests is not None:
+                with trace.span('digests'):
+                    self.save_chunk_digests(filename, channel.digest, [new_digests[n] for n in range(len(new_digests))],
+                                            channel.file_digest if file_hash else None, file_hash.digest() if file_hash else None,
+                                            version)
+            self.ui.log_message(f"File {os.path.basename(filename)} sent successfully to {client_address[0]}:{client_address[1]} at {datetime.now()} ({progress.summary()}).")
         except FileNotFoundError:
             self.ui.log_message(f"File {os.path.basename(filename)} not found at {datetime.now()}.")
             self.send_data(client_socket, b'File not found.')
 
+    def send_ranges(self, client_socket, request, trace=telemetry.NULL):
+        """Answer the 'p' action: byte ranges of one file sent back to back as a single chunk stream.
+
+        The request is {"name": ..., "ranges": [[offset, length], ...]}; a
+        negative offset counts from the end of the file and a null length
+        reads to the end. The reply is {"size": file size, "ranges": [...]}
+        with the ranges clipped to the file, or "File not found.", and the
+        chunks follow without waiting for the client.
+        """
+        try:
+            filename = batch.safe_path(self.server_folder, request['name'])
+            filesize = dedup.stored_size(filename)
+        except (ValueError, FileNotFoundError):
+            self.ui.log_message(f"File {request['name']} not found at {datetime.now()}.")
+            self.send_data(client_socket, b'File not found.')
+            return
+        ranges = []
+        for offset, length in request['ranges']:
+            offset = min(max(filesize + offset, 0) if offset < 0 else offset, filesize)
+            ranges.append([offset, filesize - offset if length is None else max(0, min(length, filesize - offset))])
+        self.send_data(client_socket, json.dumps({'size': filesize, 'ranges': ranges}).encode())
+
+        connection = self.connections[client_socket]
+        channel = connection.channel
+        progress = events.TransferProgress(self.ui, f"Sending {len(ranges)} ranges of {request['name']} to {connection.label}")
+
+        def on_ack(chunk_num, chunk_data):
+            progress.chunk(len(chunk_data))
+            connection.sent(len(chunk_data))
+
+        compress = bool(channel.codec) and protocol.should_compress(filename)
+        with self.maps.reader(filename, lambda path: dedup.open_stored(path, self.store)) as f, self.shaper.flow(connection.address[0]) as pace:
+            protocol.send_chunks(channel, protocol.read_byte_ranges(f, BUFFER_SIZE, ranges), self.window_size, on_ack,
+                                 channel.new_file_hash(), compress, pace, self.metrics.observer(trace))
+        self.ui.log_message(f"Sent {len(ranges)} ranges of {request['name']} to {connection.label} at {datetime.now()} ({progress.summary()}).")
+
+    def open_session(self, client_socket, request):
+        """Start a transfer that is carried over several data connections.
+
+        The request is "u::<filename>::<size>" or "d::<filename>". The reply is
+        "<session_id>::<size>", which the data connections quote in their 'j' action.
+        """
+        direction, request = request.split('::', 1)
+        if direction == 'u':
+            filename, filesize = request.rsplit('::', 1)
+            filesize = int(filesize)
+        else:
+            filename = request
+            try:
+                filesize = dedup.stored_size(os.path.join(self.server_folder, filename))
+            except FileNotFoundError:
+                self.ui.log_message(f"File {filename} not found at {datetime.now()}.")
+                self.send_data(client_socket, b'File not found.')
+                return
+
+        session = TransferSession(uuid.uuid4().hex, direction, filename, filesize, client_socket)
+        if direction == 'u':
+            with open(os.path.join(self.server_folder, session.temp_name), 'wb') as f:
+                f.truncate(filesize)
+        with self.session_lock:
+            self.sessions[session.session_id] = session
+
+        self.send_data(client_socket, f"{session.session_id}::{filesize}".encode())
+        self.ui.log_message(f"Opened {'upload' if direction == 'u' else 'download'} session {session.session_id} for {filename} at {datetime.now()}.")
+
+    def join_session(self, client_socket, session_id, first_chunk, last_chunk, trace=telemetry.NULL):
+        with self.session_lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            self.ui.log_message(f"Unknown transfer session {session_id} at {datetime.now()}.")
+            return
+
+        client_address = self.connections[client_socket].address
+        self.ui.log_message(f"Connection {client_address[0]}:{client_address[1]} joined session {session_id} for chunks {first_chunk}-{last_chunk - 1}.")
+        if session.direction == 'd':
+            self.send_file(client_socket, os.path.join(self.server_folder, session.filename), first_chunk, last_chunk, send_size=False, trace=trace)
+            return
+
+        progress = events.TransferProgress(self.ui, f"Receiving {session.filename} chunks {first_chunk}-{last_chunk - 1} from {client_address[0]}:{client_address[1]}")
+        with session.lock:
+            session.receiving += 1
+        chunk_count = None
+        try:
+            with open(os.path.join(self.server_folder, session.temp_name), 'r+b') as f:
+                chunk_count = self.receive_chunks(client_socket, f, progress=progress, trace=trace)
+        finally:
+            with session.lock:
+                if chunk_count is None:
+                    session.failed = True
+                else:
+                    session.received += chunk_count
+                session.receiving -= 1
+                session.lock.notify_all()
+
+    def close_session(self, client_socket, session_id):
+        with self.session_lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            self.send_data(client_socket, b"failure")
+            return
+
+        if session.direction == 'd':
+            self.send_data(client_socket, b"success")
+            return
+
+        # The client closes as soon as its data connections saw their end
+        # frames acknowledged, which can be before join_session counted them.
+        with session.lock:
+            session.lock.wait_for(lambda: session.receiving == 0)
+        temp_path = os.path.join(self.server_folder, session.temp_name)
+        if session.failed or session.received != session.chunk_count:
+            os.remove(temp_path)
+            self.ui.log_message(f"File {session.filename} upload in session {session_id} incomplete at {datetime.now()}.")
+            self.send_data(client_socket, b"failure")
+            return
+
+        filepath = os.path.join(self.server_folder, session.filename)
+        self.forget_cached(filepath)
+        os.replace(temp_path, filepath)
+        self.maps.adopt(filepath)
+        dedup.discard_recipe(filepath, self.store)
+        self.index.update(session.filename)
+        self.ui.log_message(f"File {session.filename} received successfully in session {session_id} at {datetime.now()}.")
+        self.send_data(client_socket, b"success")
+
+    def discard_sessions(self, client_socket):
+        """Drop the sessions a closed control connection left open."""
+        with self.session_lock:
+            orphaned = [session for session in self.sessions.values() if session.owner == client_socket]
+            for session in orphaned:
+                del self.sessions[session.session_id]
+        for session in orphaned:
+            temp_path = os.path.join(self.server_folder, session.temp_name)
+            if session.direction == 'u' and os.path.exists(temp_path):
+                os.remove(temp_path)
+
     def list(self, client_socket):
-        no_files = len([name for name in os.listdir(self.server_folder) if os.path.isfile(os.path.join(self.server_folder, name))])
-        self.send_data(client_socket, str(no_files).encode())
+        # Answered from the index; dot-files other than recipes never show up.
+        files = self.index.files()
+        self.send_data(client_socket, str(len(files)).encode())
 
-        for filename in os.listdir(self.server_folder):
-            filepath = os.path.join(self.server_folder, filename)
-            file_size = os.path.getsize(filepath)
-            data = filename.encode() + b'::' + str(file_size).encode()
+        for filename, entry in files:
+            data = filename.encode() + b'::' + str(entry.size).encode()
             self.send_data(client_socket, data)
 
+    def list_page(self, client_socket, request):
+        """Answer the 'l' action: one JSON reply per page instead of a frame per file.
+
+        The request is {"prefix": ..., "after": ..., "limit": ...}, all
+        optional; the reply is {"files": [[name, size, mtime_ns], ...], "next": name or null}.
+        """
+        page, next_after = self.index.page(request.get('prefix', ''), request.get('after', ''),
+                                           request.get('limit', dirindex.PAGE_SIZE))
+        reply = {'files': [[name, entry.size, entry.mtime] for name, entry in page], 'next': next_after}
+        self.send_data(client_socket, json.dumps(reply).encode())
+
+    def stat(self, client_socket, request):
+        """Answer the 's' action with {"name", "size", "mtime", "digest"} or "File not found.".
+
+        The request is {"name": ..., "digest": bool}. The digest is the
+        SHA-256 of the content; with "digest" true it is computed if the
+        index does not know it yet, and cached until the file changes.
+        """
+        filename = request['name']
+        entry = self.index.stat(filename)
+        if entry is None:
+            self.send_data(client_socket, b'File not found.')
+            return
+        if request.get('digest') and entry.digest is None:
+            with dedup.open_stored(os.path.join(self.server_folder, filename), self.store) as f:
+                digest = delta.file_digest(f)
+            self.index.set_digest(filename, entry, digest)
+            entry = entry._replace(digest=digest)
+        reply = {'name': filename, 'size': entry.size, 'mtime': entry.mtime, 'digest': entry.digest}
+        self.send_data(client_socket, json.dumps(reply).encode())
+
     def delete_file(self, client_socket, filename):
         try:
-            os.remove(os.path.join(self.server_folder, filename))
+            filepath = os.path.join(self.server_folder, filename)
+            self.forget_cached(filepath)
+            if not dedup.discard_recipe(filepath, self.store):
+                os.remove(filepath)
+            self.drop_chunk_digests(filepath)
+            self.index.update(filename)
             self.ui.log_message(f"Deleted file {filename} successfully at {datetime.now()}.")
             self.send_data(client_socket, b"success")
         except Exception as e:
             self.ui.log_message(f"Failed to delete file {filename}: {e} at {datetime.now()}.")
             self.send_data(client_socket, b"failure")
 
+    @contextmanager
+    def transfer(self, client_socket, kind, name):
+        """Mark a transfer as the connection's current one and count it in the metrics; yields its trace."""
+        connection = self.connections[client_socket]
+        connection.begin(kind, name)
+        try:
+            with self.metrics.transfer(kind, name) as trace:
+                yield trace
+        finally:
+            connection.end()
+
     def handle_client(self, client_socket, address):
         try:
             while True:
@@ -224,34 +902,98 @@ class Server:
                 if action is None:
                     break
 
-                if action == b'u':
+                if action == b'v':
+                    request = self.receive_data(client_socket).decode()
+                    self.send_data(client_socket, self.connections[client_socket].channel.answer_version(request))
+                elif action == b'u':
                     filename = self.receive_data(client_socket).decode()
-                    self.receive_file(client_socket, filename)
+                    with self.transfer(client_socket, 'upload', filename) as trace:
+                        self.receive_file(client_socket, filename, trace=trace)
                 elif action == b'd':
                     filename = self.receive_data(client_socket).decode()
-                    filename = os.path.join(self.server_folder, filename)
-                    self.send_file(client_socket, filename)
+                    with self.transfer(client_socket, 'download', filename) as trace:
+                        self.send_file(client_socket, os.path.join(self.server_folder, filename), trace=trace)
+                elif action == b'a':
+                    filename = self.receive_data(client_socket).decode()
+                    with self.transfer(client_socket, 'resume_upload', filename) as trace:
+                        self.receive_file(client_socket, filename, resume=True, trace=trace)
+                elif action == b'g':
+                    filename = self.receive_data(client_socket).decode()
+                    with self.transfer(client_socket, 'resume_download', filename) as trace:
+                        self.send_file(client_socket, os.path.join(self.server_folder, filename), ranges=True, trace=trace)
+                elif action == b'k':
+                    filename = self.receive_data(client_socket).decode()
+                    recipe = dedup.Recipe.decode(self.receive_data(client_socket))
+                    with self.transfer(client_socket, 'dedup_upload', filename) as trace:
+                        self.receive_deduplicated(client_socket, filename, recipe, trace=trace)
+                elif action == b'y':
+                    filename = self.receive_data(client_socket).decode()
+                    with self.transfer(client_socket, 'delta_upload', filename) as trace:
+                        self.receive_delta(client_socket, filename, trace=trace)
+                elif action == b'b':
+                    manifest = json.loads(self.receive_data(client_socket))
+                    with self.transfer(client_socket, 'batch_upload', f"{len(manifest)} files") as trace:
+                        self.receive_batch(client_socket, manifest, trace=trace)
+                elif action == b'f':
+                    names = json.loads(self.receive_data(client_socket))
+                    with self.transfer(client_socket, 'batch_download', f"{len(names)} files") as trace:
+                        self.send_batch(client_socket, names, trace=trace)
+                elif action == b'p':
+                    request = json.loads(self.receive_data(client_socket))
+                    with self.transfer(client_socket, 'range', request['name']) as trace:
+                        self.send_ranges(client_socket, request, trace=trace)
+                elif action == b'm':
+                    # Version 2 clients add a token for the version of their file.
+                    request = self.receive_data(client_socket).decode()
+                    if self.connections[client_socket].channel.version >= 2:
+                        filename, filesize, token = request.rsplit('::', 2)
+                    else:
+                        filename, filesize = request.rsplit('::', 1)
+                        token = ''
+                    self.missing_chunks(client_socket, filename, int(filesize), token or None)
                 elif action == b'r':
                     self.list(client_socket)
+                elif action == b'l':
+                    request = json.loads(self.receive_data(client_socket) or b'{}')
+                    self.list_page(client_socket, request)
+                elif action == b's':
+                    request = json.loads(self.receive_data(client_socket))
+                    self.stat(client_socket, request)
                 elif action == b'x':
                     filename = self.receive_data(client_socket).decode()
                     self.delete_file(client_socket, filename)
+                elif action == b'o':
+                    request = self.receive_data(client_socket).decode()
+                    self.open_session(client_socket, request)
+                elif action == b'j':
+                    session_id, first_chunk, last_chunk = self.receive_data(client_socket).decode().split('::')
+                    with self.transfer(client_socket, 'session', f"{session_id} chunks {first_chunk}-{int(last_chunk) - 1}") as trace:
+                        self.join_session(client_socket, session_id, int(first_chunk), int(last_chunk), trace=trace)
+                elif action == b'c':
+                    session_id = self.receive_data(client_socket).decode()
+                    self.close_session(client_socket, session_id)
                 elif action == b'e':
                     self.ui.log_message(f"Client {address[0]}:{address[1]} connection closed at {datetime.now()}.")
         except Exception as e:
             self.ui.log_message(f"Error handling client {address[0]}:{address[1]}: {e} at {datetime.now()}.")
         finally:
+            self.discard_sessions(client_socket)
+            self.release_partials(client_socket)
             client_socket.close()
-            with self.lock:
-                self.client_count -= 1
-                self.client_sockets = [(sock, addr) for sock, addr in self.client_sockets if addr != address]
+            self.connections.remove(client_socket)
             self.ui.update_client_count(self.client_count)
             self.ui.log_message(f"Client {address[0]}:{address[1]} connection closed at {datetime.now()}.")
+            if self.worker_slots:
+                self.worker_slots.release()
 
 
 class ServerUI:
-    def __init__(self, root):
+    def __init__(self, root, server_class=Server, server_ip=SERVER_IP, server_port=SERVER_PORT, server_folder=SERVER_FOLDER, workers=None, options=None):
         self.root = root
+        self.server_class = server_class  # Server or async_server.AsyncServer
+        self.server_folder = server_folder
+        self.workers = workers
+        self.options = options or {}  # Further keyword arguments for server_class
         self.root.title("Upload/Download Server")
         self.root.resizable(False, False)  # Lock window size
 
@@ -263,7 +1005,7 @@ class ServerUI:
 
         self.entry_ip = tk.Entry(self.frame, font=("Helvetica", 14), width=20)
         self.entry_ip.grid(row=0, column=1)
-        self.entry_ip.insert(0, SERVER_IP)
+        self.entry_ip.insert(0, server_ip)
           # Allow copying
 
         self.label_port = tk.Label(self.frame, text="Server PORT:", font=("Helvetica", 14))
@@ -271,7 +1013,7 @@ class ServerUI:
 
         self.entry_port = tk.Entry(self.frame, font=("Helvetica", 14), width=20)
         self.entry_port.grid(row=1, column=1)
-        self.entry_port.insert(0, str(SERVER_PORT))
+        self.entry_port.insert(0, str(server_port))
         self.entry_port.config(state="readonly")  # Allow copying
 
         self.start_button = tk.Button(self.frame, text="Start Server", command=self.start_server, font=("Helvetica", 14))
@@ -291,10 +1033,14 @@ class ServerUI:
         self.client_count.grid(row=4, column=1)
 
         self.server = None
+        # Server threads only queue log lines; the Tk thread inserts them in batches.
+        self.pending_messages = queue.Queue()
+        self.pending_client_count = None
+        self.root.after(LOG_FLUSH_MS, self.flush_log)
 
     def start_server(self):
         if not self.server or not self.server.running:
-            self.server = Server(self.entry_ip.get(), int(self.entry_port.get()), SERVER_FOLDER, self)
+            self.server = self.server_class(self.entry_ip.get(), int(self.entry_port.get()), self.server_folder, self, workers=self.workers, **self.options)
             self.server.start()
             self.entry_ip.config(state="readonly")
             self.entry_port.config(state="readonly")
@@ -321,14 +1067,34 @@ class ServerUI:
             self.log_message("Server is not running.")
 
     def log_message(self, message):
-        self.text_area.config(state="normal")
         current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        self.text_area.insert(tk.END, f"[{current_time}] {message}\n")
-        self.text_area.yview(tk.END)
-        self.text_area.config(state="disabled")
+        self.pending_messages.put(f"[{current_time}] {message}\n")
 
     def update_client_count(self, count):
-        self.client_count.config(text=str(count))
+        self.pending_client_count = count
+
+    def flush_log(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self.pending_messages.get_nowait())
+            except queue.Empty:
+                break
+
+        if lines:
+            self.text_area.config(state="normal")
+            self.text_area.insert(tk.END, "".join(lines))
+            line_count = int(self.text_area.index("end-1c").split(".")[0])
+            if line_count > MAX_LOG_LINES:
+                self.text_area.delete("1.0", f"{line_count - MAX_LOG_LINES}.0")
+            self.text_area.yview(tk.END)
+            self.text_area.config(state="disabled")
+
+        if self.pending_client_count is not None:
+            self.client_count.config(text=str(self.pending_client_count))
+            self.pending_client_count = None
+
+        self.root.after(LOG_FLUSH_MS, self.flush_log)
 
     def on_closing(self):
         if self.server and self.server.client_count > 0:
@@ -341,9 +1107,57 @@ class ServerUI:
         self.root.destroy()
 
 
-if __name__ == "__main__":
+def main():
+    parser = argparse.ArgumentParser(description="Upload/Download server")
+    parser.add_argument("--headless", action="store_true", help="run without the Tk window, logging to stderr")
+    parser.add_argument("--host", default=SERVER_IP)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--folder", default=SERVER_FOLDER)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="connections served at once (thread engine) or file I/O threads (async engine)")
+    parser.add_argument("--engine", choices=["thread", "async"], default="thread")
+    parser.add_argument("--rate", type=float, default=None, help="total send rate in MB/s (thread engine)")
+    parser.add_argument("--client-rate", type=float, default=None, help="send rate per client address in MB/s (thread engine)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help=f"serve /metrics and /traces on 127.0.0.1 at this port, e.g. {telemetry.METRICS_PORT} (thread engine)")
+    parser.add_argument("--trace", action="store_true", help="record per-transfer trace spans, see /traces")
+    parser.add_argument("--chunk-cache", type=float, default=None,
+                        help=f"MB of digests and compressed chunks kept for repeat downloads, default {chunkcache.CHUNK_CACHE_BYTES // shaping.MB} (thread engine)")
+    args = parser.parse_args()
+
+    server_class = AsyncServer if args.engine == "async" else Server
+    options = {}
+    if args.rate or args.client_rate:
+        if args.engine == "async":
+            parser.error("--rate and --client-rate need the thread engine")
+        options['shaper'] = shaping.Shaper(args.rate and args.rate * shaping.MB, args.client_rate and args.client_rate * shaping.MB)
+    if args.trace and args.metrics_port is None:
+        parser.error("--trace needs --metrics-port, traces are only readable from /traces")
+    if args.metrics_port is not None:
+        if args.engine == "async":
+            parser.error("--metrics-port needs the thread engine")
+        options['metrics'] = telemetry.Metrics(tracing=args.trace)
+        telemetry.serve(options['metrics'], port=args.metrics_port)
+    if args.chunk_cache is not None:
+        if args.engine == "async":
+            parser.error("--chunk-cache needs the thread engine")
+        options['chunk_cache'] = chunkcache.ChunkCache(int(args.chunk_cache * shaping.MB))
+    if args.headless:
+        server = server_class(args.host, args.port, args.folder, events.LoggingSink(), workers=args.workers, **options)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Server stopped.")
+        return
+
+    if tk is None:
+        parser.error("tkinter is not available; use --headless")
     root = tk.Tk()
-    ui = ServerUI(root)
+    ui = ServerUI(root, server_class, args.host, args.port, args.folder, args.workers, options)
     root.iconbitmap('img/server_icon.ico')
     root.protocol("WM_DELETE_WINDOW", ui.on_closing)
     root.mainloop()
+
+
+if __name__ == "__main__":
+    main()
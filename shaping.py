@@ -0,0 +1,129 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# Bandwidth shaping for what the server sends. The global rate is split
+# between the clients that are downloading, in proportion to their weights;
+# a client held below its share by the per-client rate leaves the rest to
+# the others. All connections of one client draw from one bucket, so
+# opening more of them does not buy a bigger share. Only chunk traffic is
+# paced: replies to control actions never wait on a bucket.
+BURST_SECONDS = 0.25  # Unused rate a bucket may save up, in seconds' worth
+MB = 1024 * 1024
+
+
+class TokenBucket:
+    """Paces a stream to rate bytes per second; a rate of None lets everything through.
+
+    consume() takes the tokens for a chunk at once and sleeps for as long
+    as that leaves the bucket in debt, so chunks larger than the burst
+    still average out to the rate.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _fill(self, now):
+        if self.rate:
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.rate * BURST_SECONDS)
+        self.stamp = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._fill(time.monotonic())
+            self.rate = rate
+            if not rate:
+                self.tokens = 0.0
+
+    def consume(self, size):
+        with self.lock:
+            self._fill(time.monotonic())
+            if not self.rate:
+                return
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ClientShare:
+    def __init__(self):
+        self.bucket = TokenBucket()
+        self.flows = 0
+
+
+class Shaper:
+    """Global and per-client send rates in bytes per second, None meaning unlimited.
+
+    Wrap each bulk send in flow(client) and call pace(size) before every
+    chunk. The rates and weights can be changed while transfers run.
+    """
+
+    def __init__(self, rate=None, client_rate=None):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.weights = {}  # Client -> weight, 1 unless set
+        self.clients = {}  # Client with transfers running -> ClientShare
+        self.lock = threading.Lock()
+
+    def _rebalance(self):
+        # Water-filling: clients capped below their weighted share get their
+        # cap and the remaining rate is split again among the others.
+        weight = lambda client: self.weights.get(client, 1)
+        if not self.rate:
+            for share in self.clients.values():
+                share.bucket.set_rate(self.client_rate)
+            return
+        remaining = self.rate
+        pending = sorted(self.clients, key=lambda client: (self.client_rate or self.rate) / weight(client))
+        total_weight = sum(weight(client) for client in pending)
+        for client in pending:
+            share = remaining * weight(client) / total_weight
+            if self.client_rate and self.client_rate < share:
+                share = self.client_rate
+            self.clients[client].bucket.set_rate(share)
+            remaining -= share
+            total_weight -= weight(client)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self._rebalance()
+
+    def set_client_rate(self, rate):
+        with self.lock:
+            self.client_rate = rate
+            self._rebalance()
+
+    def set_weight(self, client, weight):
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        with self.lock:
+            self.weights[client] = weight
+            self._rebalance()
+
+    def rates(self):
+        """Return the rate each client with a running transfer is currently held to."""
+        with self.lock:
+            return {client: share.bucket.rate for client, share in self.clients.items()}
+
+    @contextmanager
+    def flow(self, client):
+        """Register a transfer to client for the with block; yields the pace(size) function to call per chunk."""
+        with self.lock:
+            share = self.clients.get(client)
+            if share is None:
+                share = self.clients[client] = ClientShare()
+            share.flows += 1
+            self._rebalance()
+        try:
+            yield share.bucket.consume
+        finally:
+            with self.lock:
+                share.flows -= 1
+                if not share.flows:
+                    del self.clients[client]
+                self._rebalance()
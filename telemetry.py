@@ -0,0 +1,345 @@
+import time
+import json
+import bisect
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Counters, gauges and histograms kept in memory and rendered in the
+# Prometheus text format, plus optional per-transfer trace spans. Server
+# and Client take a Metrics; the default NULL_METRICS has the same
+# attributes doing nothing, so instrumented paths cost a no-op call when
+# metrics are off and skip their timing altogether.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+MAX_TRACES = 100  # Finished traces kept for /traces
+MAX_SPANS = 2000  # Spans kept per trace; further ones are only counted
+METRICS_PORT = 9100
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    """A metric family; labels(*values) returns the child for one combination of label values.
+
+    Families without labels are their own only child.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self.children[()] = self.new_child()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children.items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self, name, label_names, values):
+        return [f"{name}{_label_text(label_names, values)} {self.value}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+
+class GaugeChild(CounterChild):
+    def __init__(self, function=None):
+        super().__init__()
+        self.function = function  # Read at render time instead of value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, label_names, values):
+        value = self.function() if self.function else self.value
+        return [f"{name}{_label_text(label_names, values)} {value}"]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.function = function
+        super().__init__(name, help, labels)
+
+    def new_child(self):
+        return GaugeChild(self.function)
+
+    def inc(self, amount=1):
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self.children[()].dec(amount)
+
+    def set(self, value):
+        self.children[()].set(value)
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self, name, label_names, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{name}_bucket{_label_text(label_names + ('le',), values + (le,))} {cumulative}")
+        lines.append(f"{name}_sum{_label_text(label_names, values)} {self.sum}")
+        lines.append(f"{name}_count{_label_text(label_names, values)} {cumulative}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.children[()].observe(value)
+
+
+class Trace:
+    """Timed spans of one transfer, kept until MAX_SPANS and added to the span histogram."""
+
+    def __init__(self, metrics, trace_id, kind, name):
+        self.metrics = metrics
+        self.trace_id = trace_id
+        self.kind = kind
+        self.name = name
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+
+    def record(self, span, start, seconds=None):
+        """Record a span that began at perf_counter() value start and lasted seconds, or until now."""
+        if seconds is None:
+            seconds = time.perf_counter() - start
+        self.metrics.span_seconds.labels(span).observe(seconds)
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append((span, round(start - self.origin, 6), round(seconds, 6)))
+        else:
+            self.dropped += 1
+
+    @contextmanager
+    def span(self, span):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(span, start)
+
+    def to_dict(self):
+        return {'id': self.trace_id, 'kind': self.kind, 'name': self.name, 'started': self.started,
+                'seconds': round(time.perf_counter() - self.origin, 6), 'spans': self.spans, 'dropped_spans': self.dropped}
+
+
+class Metrics:
+    """The instruments Server and Client update, plus any registered with counter(), gauge() or histogram().
+
+    With tracing, every transfer also records a Trace; the last MAX_TRACES
+    are kept for the /traces endpoint.
+    """
+
+    enabled = True
+
+    def __init__(self, tracing=False):
+        self.tracing = tracing
+        self.families = {}  # Name -> family, in registration order
+        self.traces = deque(maxlen=MAX_TRACES)
+        self.trace_ids = itertools.count(1)
+        self.bytes_received = self.counter('transfer_received_bytes_total', "Chunk payload bytes received")
+        self.bytes_sent = self.counter('transfer_sent_bytes_total', "Chunk payload bytes sent and acknowledged")
+        self.chunk_latency = self.histogram('chunk_reply_seconds', "Time from sending a chunk to its ACK or NAK")
+        self.retries = self.counter('chunk_retries_total', "Chunks sent again after a NAK")
+        self.checksum_failures = self.counter('chunk_checksum_failures_total', "Received chunks that failed their digest or did not parse")
+        self.active_transfers = self.gauge('transfers_active', "Transfers in progress")
+        self.transfers = self.counter('transfers_total', "Transfers started", labels=('kind',))
+        self.span_seconds = self.histogram('transfer_span_seconds', "Duration of trace spans", labels=('span',))
+
+    def register(self, family):
+        # A family registered again, e.g. by a restarted server, replaces the old one.
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        return '\n'.join(line for family in list(self.families.values()) for line in family.render()) + '\n'
+
+    @contextmanager
+    def trace(self, kind, name):
+        """Yield a Trace for the with block, or NULL when tracing is off."""
+        if not self.tracing:
+            yield NULL
+            return
+        trace = Trace(self, next(self.trace_ids), kind, name)
+        try:
+            yield trace
+        finally:
+            self.traces.append(trace.to_dict())
+
+    @contextmanager
+    def transfer(self, kind, name):
+        """Count a transfer as active for the with block; yields its trace like trace()."""
+        self.transfers.labels(kind).inc()
+        self.active_transfers.inc()
+        try:
+            with self.trace(kind, name) as trace:
+                yield trace
+        finally:
+            self.active_transfers.dec()
+
+    def observer(self, trace=None):
+        """Return the observe(size, ok, seconds) hook for protocol.send_chunks."""
+        if trace is NULL:
+            trace = None
+
+        def observe(size, ok, seconds):
+            self.chunk_latency.observe(seconds)
+            if ok:
+                self.bytes_sent.inc(size)
+            else:
+                self.retries.inc()
+            if trace is not None:
+                trace.record('chunk', time.perf_counter() - seconds, seconds)
+        return observe
+
+
+class _Null:
+    """Stands in for every instrument and trace when metrics are off."""
+
+    def inc(self, *args):
+        pass
+
+    dec = set = observe = record = inc
+
+    def labels(self, *values):
+        return self
+
+    def span(self, span):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL = _Null()
+
+
+class NullMetrics:
+    enabled = False
+    tracing = False
+    bytes_received = bytes_sent = chunk_latency = retries = checksum_failures = NULL
+    active_transfers = transfers = span_seconds = NULL
+
+    def counter(self, *args, **kwargs):
+        return NULL
+
+    gauge = histogram = counter
+
+    def trace(self, kind, name):
+        return NULL
+
+    transfer = trace
+
+    def observer(self, trace=None):
+        return None  # send_chunks then skips timing replies altogether
+
+    def render(self):
+        return ''
+
+
+NULL_METRICS = NullMetrics()
+
+
+def serve(metrics, host='127.0.0.1', port=METRICS_PORT):
+    """Serve /metrics (Prometheus text) and /traces (JSON) on a daemon thread; returns the HTTP server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = metrics.render().encode(), 'text/plain; version=0.0.4'
+            elif self.path == '/traces':
+                body, content_type = json.dumps(list(metrics.traces)).encode(), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd